@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Benchmarks full keepoid runs against the fake `zfs` in fake_zfs.py.
+
+Seeds the fake zfs with a synthetic sanoid backlog, runs `keepoid.py run`
+against it as a separate process, and reports the wall time, the `zfs`
+calls made and the destroy throughput. Latency and failures can be
+injected into every `zfs` call to see how batching holds up.
+
+Usage: python benchmarks/bench_e2e.py [--snapshots 100k] [--datasets 100]
+       [--latency SECONDS] [--destroy-latency SECONDS] [--fail-rate P]
+       [--jobs N] [--channel-program]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from bench_planner import parse_count  # noqa: E402
+from inventory import IDENTIFIER, RETENTION, zfs_list_lines  # noqa: E402
+
+
+def write_config(path, root):
+    lines = [f"pruneAfter: 1h\npath: {root}\nidentifier: {IDENTIFIER}\nretention:\n"]
+    for policy in RETENTION:
+        lines.append(f"  - interval: {policy['interval']}\n")
+        lines.append(f"    count: {policy['count']}\n")
+    path.write_text("".join(lines))
+
+
+def run(workdir, args):
+    """Runs keepoid once, returning (seconds, snapshots destroyed, zfs calls)."""
+    bin_dir = workdir / "bin"
+    bin_dir.mkdir()
+    zfs = bin_dir / "zfs"
+    zfs.write_text(
+        f'#!/bin/sh\nexec "{sys.executable}" "{ROOT / "fake_zfs.py"}" "$@"\n'
+    )
+    zfs.chmod(0o755)
+
+    listing = workdir / "listing.txt"
+    with open(listing, "w") as f:
+        f.writelines(zfs_list_lines(args.snapshots, args.datasets, datetime.now()))
+    before = args.snapshots
+    config = workdir / "keepoid.conf"
+    write_config(config, "pool")
+    log = workdir / "zfs.log"
+
+    env = dict(
+        os.environ,
+        PATH=f"{bin_dir}:{os.environ['PATH']}",
+        FAKE_ZFS_LISTING=str(listing),
+        FAKE_ZFS_LOG=str(log),
+        FAKE_ZFS_LATENCY=str(args.latency),
+        FAKE_ZFS_DESTROY_LATENCY=str(args.destroy_latency),
+        FAKE_ZFS_FAIL_RATE=str(args.fail_rate),
+    )
+    command = [sys.executable, str(ROOT / "keepoid.py"), "run", "--config", str(config)]
+    command += ["--jobs", str(args.jobs)]
+    if args.channel_program:
+        command.append("--channel-program")
+
+    start = time.perf_counter()
+    subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+    elapsed = time.perf_counter() - start
+
+    with open(listing) as f:
+        after = sum(1 for _ in f)
+    with open(log) as f:
+        calls = [json.loads(line)[0] for line in f]
+    return elapsed, before - after, calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--snapshots", type=parse_count, default=100_000)
+    parser.add_argument("--datasets", type=parse_count, default=100)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--destroy-latency", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--channel-program", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        elapsed, destroyed, calls = run(Path(workdir), args)
+
+    print(f"{args.snapshots:,} snapshots across {args.datasets:,} datasets")
+    print(f"{'wall time':<20} {elapsed:10.2f} s")
+    print(f"{'destroyed':<20} {destroyed:10,}")
+    print(f"{'destroys/s':<20} {destroyed / elapsed:10,.0f}")
+    for command in sorted(set(calls)):
+        print(f"{'zfs ' + command + ' calls':<20} {calls.count(command):10,}")
+
+
+if __name__ == "__main__":
+    main()
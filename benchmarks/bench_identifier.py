@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Benchmarks identifier matching on the `zfs list` line-parsing hot path.
+
+Each case parses synthetic `zfs list -H -p` lines, splits the snapshot name
+from its dataset and checks the identifier, as listing does for every line.
+
+Usage: python benchmarks/bench_identifier.py [--lines N] [--repeat N]
+"""
+
+import argparse
+import sys
+import timeit
+from functools import partial
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench_parse import synthetic_lines  # noqa: E402
+from keepoid import compile_identifier, parse_snapshot_line  # noqa: E402
+
+
+def legacy_matches(lines, identifier):
+    """Substring check on the full name, split again for the dataset."""
+    matched = 0
+    for line in lines:
+        name, creation = parse_snapshot_line(line)
+        if f"@{identifier}" in name:
+            dataset = name.split("@")[0]
+            matched += dataset is not None
+    return matched
+
+
+def compiled_matches(lines, matcher):
+    """A single partition, then the compiled matcher on the snapshot part."""
+    prefix, pattern = matcher
+    matched = 0
+    for line in lines:
+        name, creation = parse_snapshot_line(line)
+        dataset, _, snapshot_name = name.partition("@")
+        if snapshot_name.startswith(prefix) and (
+            pattern is None or pattern(snapshot_name) is not None
+        ):
+            matched += 1
+    return matched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # Half the lines belong to another identifier
+    lines = synthetic_lines(args.lines)
+    lines += [line.replace("autosnap_", "syncoid_") for line in lines]
+
+    cases = [
+        ("substring (legacy)", lambda: legacy_matches(lines, "autosnap_")),
+        ("prefix", "autosnap_", "prefix"),
+        ("glob", "autosnap_*_hourly", "glob"),
+        ("regex", r"autosnap_\d{8}_hourly", "regex"),
+    ]
+    expected = len(lines) // 2
+    for label, *case in cases:
+        if len(case) == 1:
+            call = case[0]
+        else:
+            call = partial(compiled_matches, lines, compile_identifier(*case))
+        assert call() == expected, label
+        best = min(timeit.repeat(call, number=1, repeat=args.repeat))
+        print(f"{label:<22} {best * 1000:8.1f} ms  {len(lines) / best:12,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
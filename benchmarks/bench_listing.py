@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Benchmarks listing and routing for configs with overlapping targets.
+
+Builds a synthetic dataset tree and a config whose target paths overlap,
+then compares the datasets `zfs list -r` walks when given every target path
+against the minimal listing roots, and the time taken to route datasets to
+targets by scanning every target against the path-indexed lookup.
+
+Usage: python benchmarks/bench_listing.py [--fanout N] [--depth N] [--targets N]
+"""
+
+import argparse
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from keepoid import _dataset_routes, _target_routes, listing_roots  # noqa: E402
+
+
+def synthetic_tree(pools, fanout, depth):
+    """Builds the dataset names of pools trees, fanout children per level."""
+    datasets = []
+    level = [f"pool{i}" for i in range(pools)]
+    for _ in range(depth + 1):
+        datasets.extend(level)
+        level = [f"{parent}/ds{i}" for parent in level for i in range(fanout)]
+    return datasets
+
+
+def overlapping_targets(datasets, count, seed=0):
+    """Picks count target paths, biased towards shallow, overlapping ones."""
+    rng = random.Random(seed)
+    by_depth = sorted(datasets, key=lambda dataset: dataset.count("/"))
+    shallow = by_depth[: max(len(by_depth) // 10, 1)]
+    return [
+        (
+            rng.choice(shallow if rng.random() < 0.5 else by_depth),
+            f"snap{i % 3}_",
+            False,
+        )
+        for i in range(count)
+    ]
+
+
+def walked(datasets, roots):
+    """Counts the datasets `zfs list -r` visits for roots, duplicates included."""
+    return sum(
+        1
+        for root in roots
+        for dataset in datasets
+        if dataset == root or dataset.startswith(f"{root}/")
+    )
+
+
+def scan_routes(dataset, targets):
+    """Routing by checking every target, as done before the path index."""
+    routes = [
+        (len(path), position, identifier)
+        for position, (path, identifier, skip_parent) in enumerate(targets)
+        if dataset.startswith(f"{path}/") or (dataset == path and not skip_parent)
+    ]
+    routes.sort(key=lambda route: -route[0])
+    return [(position, identifier) for _, position, identifier in routes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pools", type=int, default=2)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--targets", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    datasets = synthetic_tree(args.pools, args.fanout, args.depth)
+    targets = overlapping_targets(datasets, args.targets)
+    paths = list(dict.fromkeys(path for path, *_ in targets))
+    roots = listing_roots(paths)
+    print(f"{len(datasets):,} datasets, {len(targets)} targets on {len(paths)} paths")
+
+    print(f"{'listing':<24} {'roots':>8} {'datasets walked':>16}")
+    for label, listed in (("every target path", paths), ("listing_roots", roots)):
+        print(f"{label:<24} {len(listed):8,} {walked(datasets, listed):16,}")
+
+    by_path = _target_routes(targets)
+    for dataset in datasets:
+        indexed = [position for position, _ in _dataset_routes(dataset, by_path)]
+        assert indexed == [position for position, _ in scan_routes(dataset, targets)]
+    cases = [
+        ("scan every target", lambda: [scan_routes(d, targets) for d in datasets]),
+        ("path index", lambda: [_dataset_routes(d, by_path) for d in datasets]),
+    ]
+    print(f"\n{'routing':<24} {'time':>11}")
+    for label, call in cases:
+        best = min(timeit.repeat(call, number=1, repeat=args.repeat))
+        print(f"{label:<24} {best * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Measures per-snapshot memory for test-snapshots.txt scaled up.
+
+Usage: python benchmarks/bench_memory.py [--scale N]
+"""
+
+import argparse
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from keepoid import DatasetSnapshots, Snapshot  # noqa: E402
+
+
+class DictSnapshot:
+    """The original Snapshot layout: an instance __dict__ holding a datetime."""
+
+    def __init__(self, name, creation_time):
+        self.name = name
+        self.creation_time = creation_time
+
+
+def scaled_inventory(scale):
+    """Yields (name, epoch) pairs for test-snapshots.txt repeated scale times."""
+    names = (ROOT / "test-snapshots.txt").read_text().split()
+    start = 1_700_000_000
+    for copy in range(scale):
+        for i, name in enumerate(names):
+            dataset, snapshot = name.split("@", 1)
+            yield f"{dataset}{copy:04x}@{snapshot}", start + i * 3600
+
+
+def build_objects(build, scale):
+    return [build(name, epoch) for name, epoch in scaled_inventory(scale)]
+
+
+def build_columns(scale):
+    by_dataset = {}
+    for index, (name, epoch) in enumerate(scaled_inventory(scale)):
+        dataset, _, snapshot_name = name.partition("@")
+        columns = by_dataset.get(dataset)
+        if columns is None:
+            columns = by_dataset[dataset] = DatasetSnapshots(dataset)
+        columns.append(snapshot_name, epoch, index)
+    return by_dataset
+
+
+def measure(build):
+    tracemalloc.start()
+    inventory = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if isinstance(inventory, dict):
+        return sum(len(columns) for columns in inventory.values()), current
+    return len(inventory), current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=int, default=1000)
+    args = parser.parse_args()
+
+    epoch = datetime(1970, 1, 1)
+    scale = args.scale
+
+    def legacy(name, seconds):
+        return DictSnapshot(name, epoch + timedelta(seconds=seconds))
+
+    cases = [
+        ("names only (baseline)", lambda: build_objects(lambda name, _: name, scale)),
+        ("dict + datetime (legacy)", lambda: build_objects(legacy, scale)),
+        ("Snapshot (__slots__)", lambda: build_objects(Snapshot, scale)),
+        ("DatasetSnapshots columns", lambda: build_columns(scale)),
+    ]
+    for label, build in cases:
+        count, size = measure(build)
+        print(
+            f"{label:<26} {count:>10,} snapshots  {size / 2**20:8.1f} MiB"
+            f"  {size / count:6.1f} bytes/snapshot"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""Benchmarks parsing of `zfs list` snapshot output.
+
+Usage: python benchmarks/bench_parse.py [--lines N] [--repeat N]
+"""
+
+import argparse
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from keepoid import parse_snapshot_line  # noqa: E402
+
+
+def synthetic_lines(count, properties=()):
+    """Builds `zfs list -H -p` output lines for count hourly snapshots."""
+    extra = "".join(f"\t{1000 + i}" for i in range(len(properties)))
+    start = 1_700_000_000
+    return [
+        f"backup/dataset/{i % 100:04x}@autosnap_{i:08d}_hourly\t{start + i * 3600}{extra}\n"
+        for i in range(count)
+    ]
+
+
+def parse_columns(line):
+    """The column-aligned parsing used before `-H` output."""
+    name, creation = line.strip().split()
+    return name, int(creation)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    cases = [
+        ("columns (legacy)", parse_columns, ()),
+        ("-H name,creation", parse_snapshot_line, ()),
+        ("-H name,creation,guid,used", parse_snapshot_line, ("guid", "used")),
+    ]
+    for label, parse, properties in cases:
+        lines = synthetic_lines(args.lines, properties)
+        if properties:
+            call = lambda: [parse(line, properties) for line in lines]  # noqa: E731
+        else:
+            call = lambda: [parse(line) for line in lines]  # noqa: E731
+        best = min(timeit.repeat(call, number=1, repeat=args.repeat))
+        print(f"{label:<30} {best * 1000:8.1f} ms  {args.lines / best:12,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Benchmarks each phase of a keepoid run on synthetic sanoid inventories.
+
+For each size, times parsing a `zfs list` of the inventory, grouping by
+dataset, planning retention and planning the batched destroys, both through
+the snapshot-object API (get_snapshots, group_snapshots_by_dataset,
+determine_snapshots_to_prune) and through the columnar path main uses
+(list_snapshots_by_dataset, plan_datasets). A second pass under tracemalloc
+reports each phase's peak memory. No ZFS pool is needed: `zfs list` output
+comes from benchmarks/inventory.py.
+
+Sizes are SNAPSHOTSxDATASETS, with k and M suffixes allowed.
+
+Usage: python benchmarks/bench_planner.py [--sizes 1kx1,100kx100,1Mx1k] [--no-memory]
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+from datetime import timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import keepoid  # noqa: E402
+from inventory import IDENTIFIER, NOW, RETENTION, zfs_list_lines  # noqa: E402
+
+PRUNE_AFTER = timedelta(hours=1)
+
+
+def parse_count(text):
+    """Parses counts such as 500, 100k or 10M."""
+    multiplier = {"k": 1_000, "M": 1_000_000}.get(text[-1], 1)
+    return int(text.rstrip("kM")) * multiplier
+
+
+def parse_size(text):
+    snapshots, _, datasets = text.partition("x")
+    return parse_count(snapshots), parse_count(datasets or "1")
+
+
+def phases(total, datasets):
+    """Yields (name, function) for each phase, each consuming the previous
+    phase's result."""
+
+    def parse(_):
+        keepoid._zfs_output_lines = lambda cmd: zfs_list_lines(total, datasets)
+        return keepoid.get_snapshots("pool", IDENTIFIER)
+
+    def group(snapshots):
+        return keepoid.group_snapshots_by_dataset(snapshots)
+
+    def plan(grouped):
+        to_prune = []
+        for dataset, snapshots in grouped.items():
+            pruned, _, _ = keepoid.determine_snapshots_to_prune(
+                snapshots, RETENTION, PRUNE_AFTER, "00:00", NOW, dataset
+            )
+            to_prune.extend(pruned)
+        return to_prune
+
+    def batch(to_prune):
+        return list(keepoid.plan_destroy_batches(to_prune))
+
+    def list_columns(_):
+        keepoid._zfs_output_lines = lambda cmd: zfs_list_lines(total, datasets)
+        return keepoid.list_snapshots_by_dataset("pool", IDENTIFIER)
+
+    def plan_columns(by_dataset):
+        policies = [keepoid.compile_policy(p, "00:00") for p in RETENTION]
+        plans = keepoid.plan_datasets(
+            by_dataset,
+            policies,
+            keepoid.to_seconds(NOW),
+            keepoid.prune_cutoff(NOW, PRUNE_AFTER),
+            workers=1,
+        )
+        return [
+            by_dataset[dataset].snapshot(i)
+            for dataset, (to_prune, _, _) in plans.items()
+            for i in to_prune
+        ]
+
+    yield "get_snapshots", parse
+    yield "group_snapshots_by_dataset", group
+    yield "determine_snapshots_to_prune", plan
+    yield "plan_destroy_batches", batch
+    yield "list_snapshots_by_dataset", list_columns
+    yield "plan_datasets", plan_columns
+    yield "plan_destroy_batches (columns)", batch
+
+
+def run(total, datasets, memory):
+    """Runs every phase, returning (name, seconds, peak bytes) per phase."""
+    results = []
+    value = None
+    for name, phase in phases(total, datasets):
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        value = phase(value)
+        elapsed = time.perf_counter() - start
+        peak = None
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results.append((name, elapsed, peak))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1kx1,100kx100,1Mx1k")
+    parser.add_argument(
+        "--no-memory", action="store_true", help="Skip the tracemalloc pass."
+    )
+    args = parser.parse_args()
+
+    # Warm up, so lazily imported modules aren't charged to the first size
+    run(100, 1, memory=False)
+    for size in args.sizes.split(","):
+        total, datasets = parse_size(size)
+        timings = run(total, datasets, memory=False)
+        peaks = run(total, datasets, memory=True) if not args.no_memory else None
+        print(f"\n{total:,} snapshots across {datasets:,} datasets")
+        print(f"{'phase':<30} {'time':>10} {'snapshots/s':>14} {'peak memory':>12}")
+        for i, (name, elapsed, _) in enumerate(timings):
+            peak = f"{peaks[i][2] / 2**20:9.1f} MiB" if peaks else ""
+            rate = total / elapsed if elapsed else float("inf")
+            print(f"{name:<30} {elapsed * 1000:7.1f} ms {rate:14,.0f} {peak:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Synthetic snapshot inventories with sanoid's naming and cadences.
+
+Every dataset gets the snapshots sanoid would have taken on the same
+schedule: one every 15 minutes (frequently), plus hourly, daily and
+monthly ones at the matching boundaries. Output lines are ordered by
+creation across all datasets, as `zfs list -s createtxg` reports them.
+"""
+
+from datetime import datetime, timedelta
+
+IDENTIFIER = "autosnap_"
+# The retention policies from README.md
+RETENTION = [
+    {"interval": "1h", "count": 24},
+    {"interval": "6h", "count": 42},
+    {"interval": "1d", "count": 30},
+    {"interval": "30d", "count": 3},
+]
+NOW = datetime(2024, 6, 1, 12, 7)
+TICK = timedelta(minutes=15)
+
+
+def dataset_names(count, root="pool"):
+    """Builds count dataset names under root, 100 children per parent."""
+    return [f"{root}/ds{i // 100:03d}/sub{i % 100:02d}" for i in range(count)]
+
+
+def snapshot_suffixes(when):
+    """Returns the sanoid snapshot types taken at when."""
+    suffixes = ["frequently"]
+    if when.minute == 0:
+        suffixes.append("hourly")
+        if when.hour == 0:
+            suffixes.append("daily")
+            if when.day == 1:
+                suffixes.append("monthly")
+    return suffixes
+
+
+def schedule(per_dataset, now=NOW):
+    """Returns (datetime, suffix) for a dataset's per_dataset most recent
+    snapshots, oldest first."""
+    events = []
+    when = now.replace(minute=now.minute - now.minute % 15, second=0)
+    while len(events) < per_dataset:
+        events.extend((when, suffix) for suffix in reversed(snapshot_suffixes(when)))
+        when -= TICK
+    return events[:per_dataset][::-1]
+
+
+def zfs_list_lines(total, datasets, now=NOW):
+    """Yields `zfs list -H -p -o name,creation` lines for total snapshots
+    spread evenly over datasets datasets."""
+    names = dataset_names(datasets)
+    per_dataset = -(-total // datasets)
+    emitted = 0
+    for when, suffix in schedule(per_dataset, now):
+        stamp = when.strftime("%Y-%m-%d_%H:%M:%S")
+        epoch = int(when.timestamp())
+        for dataset in names:
+            if emitted == total:
+                return
+            yield f"{dataset}@{IDENTIFIER}{stamp}_{suffix}\t{epoch}\n"
+            emitted += 1
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""A stand-in `zfs` executable for end-to-end tests and benchmarks.
+
+Serves the `zfs list`, `zfs destroy` and `zfs program` calls keepoid makes
+from a snapshot state file, so full runs can be tested on any machine.
+Install it on PATH as `zfs`. It is configured through the environment:
+
+    FAKE_ZFS_LISTING   State file, one snapshot per line in creation order:
+                       name, creation epoch and optionally guid and used,
+                       tab-separated. Destroys remove lines from it.
+    FAKE_ZFS_READONLY  If set, destroys are checked but not written back.
+    FAKE_ZFS_DATASETS  If set, `zfs list -t filesystem,volume` prints this
+                       file verbatim, or fails as if snapshots_changed were
+                       unsupported when it doesn't exist. Otherwise datasets
+                       and their snapshots_changed come from the state.
+    FAKE_ZFS_LOG       Appends the JSON argv of every call to this file, and
+                       copies channel programs to the same path plus ".lua".
+    FAKE_ZFS_LATENCY   Seconds every call sleeps before doing anything.
+    FAKE_ZFS_DESTROY_LATENCY
+                       Seconds each destroyed snapshot adds to its call.
+    FAKE_ZFS_FAIL      Destroys and listings whose last argument contains
+                       this string fail.
+    FAKE_ZFS_FAIL_RATE Probability that any destroy call fails.
+    FAKE_ZFS_PROGRAM   "unsupported" makes `zfs program` fail as on ZFS
+                       versions without channel programs.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+from contextlib import contextmanager
+
+
+def fail(message, status=1):
+    sys.stderr.write(f"{message}\n")
+    sys.exit(status)
+
+
+@contextmanager
+def locked(path, exclusive):
+    """Serializes access to the state across concurrent calls."""
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def read_state(path):
+    """Returns the lines of the state in path."""
+    try:
+        with open(path) as f:
+            return f.readlines()
+    except FileNotFoundError:
+        return []
+
+
+def write_state(path, lines):
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as f:
+        f.writelines(lines)
+    os.replace(temporary, path)
+
+
+def read_changed(path):
+    try:
+        with open(f"{path}.changed") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def column(columns, prop):
+    """Returns a snapshot property, deriving a stable guid if none is set."""
+    name = columns[0]
+    if prop == "name":
+        return name
+    if prop == "creation":
+        return columns[1]
+    if prop == "guid":
+        if len(columns) > 2:
+            return columns[2]
+        return str(int.from_bytes(hashlib.sha1(name.encode()).digest()[:8], "big"))
+    if prop == "used":
+        return columns[3] if len(columns) > 3 else "0"
+    fail(f"bad property list: invalid property '{prop}'", 2)
+
+
+def under(dataset, path, depth):
+    """Whether dataset is path or below it, at most depth levels down."""
+    if dataset == path:
+        levels = 0
+    elif dataset.startswith(f"{path}/"):
+        levels = dataset[len(path) :].count("/")
+    else:
+        return False
+    return depth is None or levels <= depth
+
+
+def list_paths(args):
+    """Splits `zfs list` options from the paths, returning (depth, paths)."""
+    depth = None
+    paths = []
+    i = 0
+    while i < len(args):
+        if args[i] in ("-o", "-s", "-t"):
+            i += 1
+        elif args[i] == "-d":
+            depth = int(args[i + 1])
+            i += 1
+        elif not args[i].startswith("-"):
+            paths.append(args[i])
+        i += 1
+    return depth, paths
+
+
+def zfs_list(args, state_path):
+    props = args[args.index("-o") + 1].split(",")
+    depth, paths = list_paths(args)
+    if "filesystem,volume" in args:
+        return list_datasets(props, paths, depth, state_path)
+
+    # Like zfs, a snapshot counts as one level below its dataset, so -d 1
+    # lists the snapshots of the paths themselves and none of their children
+    if depth is not None:
+        depth -= 1
+    with locked(state_path, exclusive=False):
+        lines = read_state(state_path)
+    for line in lines:
+        columns = line.rstrip("\n").split("\t")
+        dataset = columns[0].partition("@")[0]
+        # Every snapshot is listed once, however many paths cover it
+        if any(under(dataset, path, depth) for path in paths):
+            sys.stdout.write("\t".join(column(columns, p) for p in props) + "\n")
+    if os.environ.get("FAKE_ZFS_FAIL") and os.environ["FAKE_ZFS_FAIL"] in args[-1]:
+        fail("cannot open dataset: permission denied")
+
+
+def list_datasets(props, paths, depth, state_path):
+    datasets_file = os.environ.get("FAKE_ZFS_DATASETS")
+    if datasets_file:
+        if not os.path.exists(datasets_file):
+            fail("bad property list: invalid property 'snapshots_changed'", 2)
+        with open(datasets_file) as f:
+            sys.stdout.write(f.read())
+        return
+
+    with locked(state_path, exclusive=False):
+        lines = read_state(state_path)
+        changed = read_changed(state_path)
+    # snapshots_changed is the last creation or destroy of a snapshot
+    for line in lines:
+        name, creation = line.split("\t", 2)[:2]
+        dataset = name.partition("@")[0]
+        changed[dataset] = max(changed.get(dataset, 0), int(creation))
+    for dataset in sorted(changed):
+        if any(under(dataset, path, depth) for path in paths):
+            values = {"name": dataset, "snapshots_changed": str(changed[dataset])}
+            sys.stdout.write("\t".join(values[p] for p in props) + "\n")
+
+
+def resolve(lines, argument):
+    """Returns the names `zfs destroy argument` refers to.
+
+    argument is dataset@a,b,c where each entry is a snapshot name or a
+    first%last range, either end of which may be left open.
+    """
+    dataset, _, entries = argument.partition("@")
+    prefix = f"{dataset}@"
+    names = [
+        line.partition("\t")[0][len(prefix) :]
+        for line in lines
+        if line.startswith(prefix)
+    ]
+    positions = {name: i for i, name in enumerate(names)}
+    selected = []
+    for entry in entries.split(","):
+        if "%" in entry:
+            first, _, last = entry.partition("%")
+            start = positions.get(first) if first else 0
+            end = positions.get(last) if last else len(names) - 1
+            if start is None or end is None:
+                continue
+            selected.extend(names[start : end + 1])
+        elif entry in positions:
+            selected.append(entry)
+    return [f"{dataset}@{name}" for name in dict.fromkeys(selected)]
+
+
+def destroy_names(state_path, lines, names):
+    """Removes names from the state, recording when each dataset changed."""
+    if os.environ.get("FAKE_ZFS_DESTROY_LATENCY"):
+        time.sleep(float(os.environ["FAKE_ZFS_DESTROY_LATENCY"]) * len(names))
+    if os.environ.get("FAKE_ZFS_READONLY"):
+        return
+    doomed = set(names)
+    # Only lines of the datasets destroyed from need their names checked
+    datasets = tuple({name.partition("@")[0] + "@" for name in names})
+    write_state(
+        state_path,
+        [
+            line
+            for line in lines
+            if not line.startswith(datasets) or line.partition("\t")[0] not in doomed
+        ],
+    )
+    changed = read_changed(state_path)
+    now = int(time.time())
+    for name in names:
+        changed[name.partition("@")[0]] = now
+    with open(f"{state_path}.changed", "w") as f:
+        json.dump(changed, f)
+
+
+def zfs_destroy(args, state_path):
+    argument = args[-1]
+    fail_on = os.environ.get("FAKE_ZFS_FAIL")
+    rate = float(os.environ.get("FAKE_ZFS_FAIL_RATE", 0))
+    if (fail_on and fail_on in argument) or random.random() < rate:
+        fail("cannot destroy snapshot: dataset is busy")
+    with locked(state_path, exclusive=True):
+        lines = read_state(state_path)
+        names = resolve(lines, argument)
+        if not names:
+            fail("could not find any snapshots to destroy; check snapshot names.")
+        if "-n" not in args:
+            destroy_names(state_path, lines, names)
+
+
+def zfs_program(args, state_path):
+    script = args[args.index("-m") + 3]
+    names = args[args.index("-m") + 4 :]
+    if os.environ.get("FAKE_ZFS_LOG"):
+        with open(script) as src, open(os.environ["FAKE_ZFS_LOG"] + ".lua", "w") as dst:
+            dst.write(src.read())
+    if os.environ.get("FAKE_ZFS_PROGRAM") == "unsupported":
+        fail("unrecognized command 'program'", 2)
+    with locked(state_path, exclusive=True):
+        lines = read_state(state_path)
+        existing = {line.partition("\t")[0] for line in lines}
+        # Like keepoid's channel program: all or nothing, reporting ENOENT
+        failed = {name: 2 for name in names if name not in existing}
+        if not failed:
+            destroy_names(state_path, lines, names)
+    sys.stdout.write(json.dumps({"return": failed}))
+
+
+def main(args):
+    if os.environ.get("FAKE_ZFS_LOG"):
+        with open(os.environ["FAKE_ZFS_LOG"], "a") as f:
+            f.write(json.dumps(args) + "\n")
+    if os.environ.get("FAKE_ZFS_LATENCY"):
+        time.sleep(float(os.environ["FAKE_ZFS_LATENCY"]))
+    state_path = os.environ["FAKE_ZFS_LISTING"]
+    commands = {"list": zfs_list, "destroy": zfs_destroy, "program": zfs_program}
+    if not args or args[0] not in commands:
+        fail(f"unrecognized command '{args[0] if args else ''}'", 2)
+    commands[args[0]](args[1:], state_path)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 
-import argparse
-import subprocess
-import yaml
+import bisect
+import os
+import signal
+from array import array
 from datetime import datetime, timedelta, time
+from time import localtime, perf_counter
+from time import time as systime
+from typing import NamedTuple, Optional
 
 
 def parse_duration(duration_str):
@@ -22,62 +26,1405 @@ def parse_duration(duration_str):
         raise ValueError(f"Unknown duration unit: {unit}")
 
 
+# Linux caps each argv string at 128KiB (MAX_ARG_STRLEN), well below ARG_MAX
+MAX_ARG_STRLEN = 131072
+
+# Limits passed to `zfs program`, matching the OpenZFS defaults
+CHANNEL_PROGRAM_INSTRUCTION_LIMIT = 10_000_000
+CHANNEL_PROGRAM_MEMORY_LIMIT = 10 * 1024 * 1024
+
+# Destroys every snapshot passed as an argument within a single transaction
+# group. If any snapshot can't be destroyed, nothing is, and the failures
+# are returned as a table of snapshot name to errno.
+CHANNEL_PROGRAM = """\
+local args = ...
+local argv = args["argv"]
+local failed = {}
+local failures = 0
+for _, snapshot in ipairs(argv) do
+    local err = zfs.check.destroy(snapshot)
+    if err ~= 0 then
+        failed[snapshot] = err
+        failures = failures + 1
+    end
+end
+if failures == 0 then
+    for _, snapshot in ipairs(argv) do
+        zfs.sync.destroy(snapshot)
+    end
+end
+return failed
+"""
+
+
+# Properties that can be requested from `zfs list` on top of name and creation
+OPTIONAL_SNAPSHOT_PROPERTIES = ("guid", "used")
+
+# Times are handled as whole seconds since this naive epoch, in local time
+LOCAL_EPOCH = datetime(1970, 1, 1)
+ONE_SECOND = timedelta(seconds=1)
+SECONDS_PER_DAY = 86400
+
+# Retention engines selectable with --engine
+ENGINES = ("python", "numpy")
+IDENTIFIER_MATCHES = ("prefix", "glob", "regex")
+COMMANDS = ("run", "daemon", "plan", "apply")
+PLAN_VERSION = 1
+
+# Below this many snapshots, planning in worker processes costs more than it saves
+PARALLEL_PLANNING_THRESHOLD = 200_000
+
+
+def to_seconds(dt: datetime) -> int:
+    """Converts a naive local datetime to whole seconds since LOCAL_EPOCH."""
+    return (dt - LOCAL_EPOCH) // ONE_SECOND
+
+
+def from_seconds(seconds: int) -> datetime:
+    """Converts whole seconds since LOCAL_EPOCH back to a naive local datetime."""
+    return LOCAL_EPOCH + timedelta(seconds=seconds)
+
+
+def local_seconds(epoch: int) -> int:
+    """Converts a Unix timestamp to whole seconds since LOCAL_EPOCH.
+
+    Equivalent to to_seconds(datetime.fromtimestamp(epoch)), without
+    building a datetime.
+    """
+    return epoch + localtime(epoch).tm_gmtoff
+
+
 class Snapshot:
-    def __init__(self, name: str, creation_time: datetime):
+    __slots__ = ("name", "creation", "index", "guid", "used")
+
+    def __init__(
+        self,
+        name: str,
+        creation_time,
+        index: int = None,
+        guid: int = None,
+        used: int = None,
+    ):
         self.name = name
-        self.creation_time = creation_time
+        # Whole seconds since LOCAL_EPOCH; a datetime is converted on the way in
+        if isinstance(creation_time, datetime):
+            if creation_time.microsecond:
+                raise ValueError(
+                    f"Snapshot creation times are whole seconds, got {creation_time}."
+                )
+            creation_time = to_seconds(creation_time)
+        self.creation = creation_time
+        # Position within the dataset's full snapshot listing, in creation order
+        self.index = index
+        # Only populated when requested from `zfs list`
+        self.guid = guid
+        self.used = used
+
+    @property
+    def creation_time(self) -> datetime:
+        return from_seconds(self.creation)
 
     def __repr__(self):
         return f"Snapshot(name='{self.name}', creation_time='{self.creation_time}')"
 
 
-def get_snapshots(path, identifier, skip_parent=False):
-    """Lists ZFS snapshots for a given path and filters by identifier."""
-    cmd = [
+def _zfs_output_lines(cmd):
+    """Yields lines of a zfs command's output as they are produced.
+
+    Raises subprocess.CalledProcessError once the output is exhausted if the
+    command failed.
+    """
+    import subprocess
+    import tempfile
+
+    # stderr goes to a file so a chatty zfs can't block while stdout is read
+    with tempfile.TemporaryFile("w+") as stderr:
+        with subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=stderr, text=True
+        ) as process:
+            yield from process.stdout
+        if process.returncode:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(
+                process.returncode, cmd, stderr=stderr.read()
+            )
+
+
+def parse_snapshot_line(line, properties=()):
+    """Parses a line of `zfs list -H -p -o name,creation,...` output.
+
+    Returns a tuple of the name, the creation epoch and the integer value of
+    each extra property, in the order requested. Raises ValueError for a
+    malformed line.
+    """
+    fields = line.rstrip("\n").split("\t")
+    if len(fields) != len(properties) + 2:
+        raise ValueError(f"Unexpected zfs list output: {line!r}")
+    try:
+        if not properties:
+            return fields[0], int(fields[1])
+        return (fields[0], int(fields[1]), *map(int, fields[2:]))
+    except ValueError:
+        raise ValueError(f"Unexpected zfs list output: {line!r}") from None
+
+
+def snapshot_list_command(paths, properties=(), depth=None):
+    """Builds the `zfs list` command for the snapshots under paths.
+
+    Lists recursively, or down to depth levels below each path if given.
+    """
+    return [
         "zfs",
         "list",
+        "-H",
+        "-p",
         "-t",
         "snapshot",
         "-o",
-        "name,creation",
+        ",".join(("name", "creation", *properties)),
         "-s",
-        "creation",
-        "-r",
-        "-p",
-        path,
+        "createtxg",
+        *(["-r"] if depth is None else ["-d", str(depth)]),
+        *paths,
+    ]
+
+
+def _iter_listed_snapshots(paths, properties=(), depth=None, lines=None):
+    """Streams (dataset, snapshot name, creation epoch, index, values) for
+    every snapshot `zfs list` reports under paths.
+
+    lines replaces the output of `zfs list`, such as with an inventory
+    exported by snapshot_list_command; paths is then ignored.
+    """
+    if lines is None:
+        lines = _zfs_output_lines(snapshot_list_command(paths, properties, depth))
+    positions = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        name, creation_epoch, *values = parse_snapshot_line(line, properties)
+        dataset, _, snapshot_name = name.partition("@")
+        index = positions.get(dataset, 0)
+        positions[dataset] = index + 1
+        yield dataset, snapshot_name, creation_epoch, index, values
+
+
+class IdentifierMatcher(NamedTuple):
+    """A compiled identifier, matched against the snapshot part of a name.
+
+    A snapshot name matches if it starts with prefix and, when set, pattern
+    matches it too; see compile_identifier.
+    """
+
+    prefix: str
+    # The bound match method of a compiled regular expression
+    pattern: Optional[object] = None
+
+    def matches(self, snapshot_name):
+        return snapshot_name.startswith(self.prefix) and (
+            self.pattern is None or self.pattern(snapshot_name) is not None
+        )
+
+
+def compile_identifier(identifier, match="prefix") -> IdentifierMatcher:
+    """Compiles an identifier into an IdentifierMatcher.
+
+    match is one of IDENTIFIER_MATCHES: prefix matches snapshot names
+    starting with identifier, glob matches the whole name against a shell
+    pattern, and regex matches a regular expression from the start of the
+    name. Raises ValueError for an unknown match or an invalid regex.
+    """
+    if match == "prefix":
+        return IdentifierMatcher(identifier)
+    import re
+
+    if match == "glob":
+        from fnmatch import translate
+
+        # The literal start of the pattern rejects most names without a regex
+        prefix = re.split(r"[*?\[]", identifier, maxsplit=1)[0]
+        return IdentifierMatcher(prefix, re.compile(translate(identifier)).match)
+    if match == "regex":
+        try:
+            return IdentifierMatcher("", re.compile(identifier).match)
+        except re.error as e:
+            raise ValueError(f"Invalid identifier regex {identifier!r}: {e}.") from None
+    raise ValueError(
+        f"Unknown identifierMatch {match!r}, expected one of {', '.join(IDENTIFIER_MATCHES)}."
+    )
+
+
+def _filter_snapshot_records(records, path, identifier, skip_parent=False):
+    """Filters listed snapshot records by identifier prefix, converting
+    creation times to seconds since LOCAL_EPOCH."""
+    matches = compile_identifier(identifier).matches
+    for dataset, snapshot_name, creation_epoch, index, values in records:
+        if matches(snapshot_name):
+            if skip_parent and dataset == path:
+                continue
+            yield dataset, snapshot_name, local_seconds(creation_epoch), index, values
+
+
+def _iter_snapshot_records(path, identifier, skip_parent=False, properties=()):
+    """Streams (dataset, snapshot name, creation, index, values) for the
+    snapshots under path matching identifier."""
+    records = _iter_listed_snapshots([path], properties)
+    return _filter_snapshot_records(records, path, identifier, skip_parent)
+
+
+def iter_snapshots(path, identifier, skip_parent=False, properties=()):
+    """Streams ZFS snapshots for a given path, filtered by identifier.
+
+    properties names any of OPTIONAL_SNAPSHOT_PROPERTIES to fetch and set on
+    each snapshot; only name and creation are listed by default.
+    """
+    records = _iter_snapshot_records(path, identifier, skip_parent, properties)
+    for dataset, snapshot_name, creation, index, values in records:
+        snapshot = Snapshot(f"{dataset}@{snapshot_name}", creation, index)
+        for prop, value in zip(properties, values):
+            setattr(snapshot, prop, value)
+        yield snapshot
+
+
+class DatasetSnapshots:
+    """Column store for the snapshots of a single dataset, in listing order.
+
+    Holds snapshot names without the dataset prefix alongside packed arrays
+    of creation times and listing positions, which takes a fraction of the
+    memory of one Snapshot object per snapshot. Snapshot objects are only
+    built on request.
+    """
+
+    __slots__ = ("dataset", "names", "creations", "indexes", "properties")
+
+    def __init__(self, dataset, properties=()):
+        self.dataset = dataset
+        self.names = []
+        self.creations = array("q")
+        self.indexes = array("q")
+        self.properties = {prop: array("Q") for prop in properties}
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, snapshot_name, creation, index, values=()):
+        self.names.append(snapshot_name)
+        self.creations.append(creation)
+        self.indexes.append(index)
+        for column, value in zip(self.properties.values(), values):
+            column.append(value)
+
+    def snapshot(self, i):
+        """Builds the Snapshot at position i."""
+        snapshot = Snapshot(
+            f"{self.dataset}@{self.names[i]}", self.creations[i], self.indexes[i]
+        )
+        for prop, column in self.properties.items():
+            setattr(snapshot, prop, column[i])
+        return snapshot
+
+    def snapshots(self):
+        return [self.snapshot(i) for i in range(len(self))]
+
+
+def listing_roots(paths):
+    """Returns the minimal paths whose recursive listings cover every path.
+
+    Paths nested under another path are dropped, since a recursive listing
+    of the outer path already includes them, as are duplicates. Keeps the
+    remaining paths in their original order.
+    """
+    roots = set()
+    for path in sorted(set(paths), key=lambda path: path.count("/")):
+        ancestor = path
+        while ancestor not in roots and "/" in ancestor:
+            ancestor = ancestor.rpartition("/")[0]
+        if ancestor not in roots:
+            roots.add(path)
+    return [path for path in dict.fromkeys(paths) if path in roots]
+
+
+def _target_routes(targets):
+    """Indexes targets by path for _dataset_routes, compiling identifiers.
+
+    Each target's identifier is compiled once, and routed by the matches
+    method of its IdentifierMatcher. Targets other than Target, such as
+    plain (path, identifier, skip_parent) tuples, match by prefix.
+    """
+    by_path = {}
+    for position, target in enumerate(targets):
+        path, identifier, skip_parent = target[:3]
+        match = target.identifier_match if isinstance(target, Target) else "prefix"
+        matches = compile_identifier(identifier, match).matches
+        by_path.setdefault(path, []).append((position, matches, skip_parent))
+    return by_path
+
+
+def _dataset_routes(dataset, by_path):
+    """Returns (position, matches) for each target dataset may belong to,
+    the target with the longest path first, where matches is the bound
+    IdentifierMatcher.matches of the target's identifier.
+
+    Takes one lookup in the index from _target_routes per level of the
+    dataset's path.
+    """
+    routes = [
+        (position, matches)
+        for position, matches, skip_parent in by_path.get(dataset, ())
+        if not skip_parent
     ]
+    ancestor = dataset
+    while "/" in ancestor:
+        ancestor = ancestor.rpartition("/")[0]
+        routes.extend(
+            (position, matches) for position, matches, _ in by_path.get(ancestor, ())
+        )
+    return routes
+
+
+def _route_snapshot_records(records, targets):
+    """Routes listed snapshot records to the targets they belong to.
+
+    Each snapshot goes to the target with the longest path containing its
+    dataset whose identifier it matches, if any. Yields (target position,
+    dataset, snapshot name, creation, index, values), with creation times
+    converted to seconds since LOCAL_EPOCH.
+    """
+    by_path = _target_routes(targets)
+    routes = {}
+    for dataset, snapshot_name, creation_epoch, index, values in records:
+        candidates = routes.get(dataset)
+        if candidates is None:
+            candidates = routes[dataset] = _dataset_routes(dataset, by_path)
+        for position, matches in candidates:
+            if matches(snapshot_name):
+                creation = local_seconds(creation_epoch)
+                yield position, dataset, snapshot_name, creation, index, values
+                break
+
+
+def list_target_snapshots(
+    targets, properties=(), cache=None, reusable_plans=None, lines=None
+):
+    """Lists ZFS snapshots for several targets with a single listing.
+
+    targets are sequences starting with (path, identifier, skip_parent),
+    such as Target. The listing_roots of the targets' paths are listed by
+    one `zfs list`, so overlapping subtrees are only walked once, and
+    snapshots are routed to targets as by _route_snapshot_records. Returns
+    a mapping of dataset to DatasetSnapshots for each target, in order.
+
+    With an InventoryCache, only datasets whose snapshots changed since the
+    last run are listed from ZFS, and unchanged datasets in reusable_plans
+    are left out altogether (see InventoryCache.refresh).
+
+    lines, if given, is read as the `zfs list` output instead of running it,
+    such as an inventory exported from another host; the cache is not used.
+    Returns None if the listing failed, after printing the error.
+    """
+    import subprocess
+
+    roots = listing_roots([target[0] for target in targets])
+    by_target = [{} for _ in targets]
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        lines = result.stdout.strip().split("\n")[1:]  # Skip header
-        snapshots = []
+        if lines is not None:
+            records = _iter_listed_snapshots(roots, properties, lines=lines)
+        elif cache is not None and set(properties) <= set(InventoryCache.PROPERTIES):
+            records = cache.refresh(roots, properties, reusable_plans)
+        else:
+            records = _iter_listed_snapshots(roots, properties)
+        routed = _route_snapshot_records(records, targets)
+        for position, dataset, snapshot_name, creation, index, values in routed:
+            by_dataset = by_target[position]
+            columns = by_dataset.get(dataset)
+            if columns is None:
+                columns = by_dataset[dataset] = DatasetSnapshots(dataset, properties)
+            columns.append(snapshot_name, creation, index, values)
+    except FileNotFoundError:
+        print("Error: 'zfs' command not found. Is ZFS installed and in your PATH?")
+    except subprocess.CalledProcessError as e:
+        print(f"Error listing snapshots for {', '.join(roots)}: {e.stderr}")
+    except ValueError as e:
+        if lines is not None:
+            print(f"Error: Invalid inventory: {e}")
+        else:
+            print(f"Error listing snapshots for {', '.join(roots)}: {e}")
+    else:
+        return by_target
+    return None
+
+
+def list_snapshots_by_dataset(
+    path, identifier, skip_parent=False, properties=(), cache=None, reusable_plans=None
+):
+    """Lists ZFS snapshots for a given path into a DatasetSnapshots per dataset.
+
+    With an InventoryCache, only datasets whose snapshots changed since the
+    last run are listed from ZFS, and unchanged datasets in reusable_plans
+    are left out altogether (see InventoryCache.refresh).
+    """
+    targets = [(path, identifier, skip_parent)]
+    by_target = list_target_snapshots(targets, properties, cache, reusable_plans)
+    return {} if by_target is None else by_target[0]
+
+
+def dataset_list_command(paths, properties):
+    """Builds the `zfs list` command for the datasets under paths."""
+    return [
+        "zfs",
+        "list",
+        "-H",
+        "-p",
+        "-t",
+        "filesystem,volume",
+        "-o",
+        ",".join(("name", *properties)),
+        "-r",
+        *paths,
+    ]
+
+
+def _signed64(value):
+    """Maps an unsigned 64-bit integer onto SQLite's signed INTEGER range."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _unsigned64(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class InventoryCache:
+    """On-disk cache of snapshot listings, keyed by dataset and snapshot guid.
+
+    Each dataset's snapshots are re-listed only when its snapshots_changed
+    property differs from the value recorded when it was last listed. On
+    ZFS versions without snapshots_changed every dataset is always
+    re-listed, since nothing else reliably reveals a snapshot being
+    destroyed.
+    """
+
+    # Snapshot properties that can be served from the cache
+    PROPERTIES = ("guid",)
+    SCHEMA_VERSION = 2
+    # Re-list the whole tree in one go when more datasets than this changed
+    FULL_LISTING_RATIO = 0.5
+
+    def __init__(self, path):
+        import sqlite3
+
+        # Datasets skipped by the last refresh, mapped to their stored plan
+        self.reused = {}
+        self.connection = sqlite3.connect(path)
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            self.connection.executescript(f"""
+                DROP TABLE IF EXISTS datasets;
+                DROP TABLE IF EXISTS snapshots;
+                DROP TABLE IF EXISTS plans;
+                CREATE TABLE datasets (
+                    name TEXT PRIMARY KEY,
+                    snapshots_changed INTEGER
+                );
+                CREATE TABLE snapshots (
+                    dataset TEXT NOT NULL,
+                    guid INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    creation INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    PRIMARY KEY (dataset, guid)
+                );
+                CREATE TABLE plans (
+                    dataset TEXT PRIMARY KEY,
+                    plan_key TEXT NOT NULL,
+                    valid_until INTEGER,
+                    snapshots INTEGER NOT NULL,
+                    policy_kept INTEGER NOT NULL,
+                    prune_after_kept INTEGER NOT NULL
+                );
+                PRAGMA user_version = {self.SCHEMA_VERSION};
+                """)
+
+    def close(self):
+        self.connection.close()
+
+    def fingerprints(self, path):
+        """Returns the recorded snapshots_changed of each dataset under path."""
+        rows = self.connection.execute(
+            "SELECT name, snapshots_changed FROM datasets"
+            " WHERE name = ? OR substr(name, 1, ?) = ?",
+            (path, len(path) + 1, f"{path}/"),
+        )
+        return dict(rows)
+
+    def invalidate(self, datasets):
+        """Forces datasets to be re-listed on the next refresh.
+
+        Called before destroying snapshots, so that a run failing partway
+        through can't leave a stale listing behind.
+        """
+        with self.connection:
+            for dataset in datasets:
+                self.connection.execute(
+                    "UPDATE datasets SET snapshots_changed = NULL WHERE name = ?",
+                    (dataset,),
+                )
+                self.connection.execute(
+                    "DELETE FROM plans WHERE dataset = ?", (dataset,)
+                )
+
+    def valid_plans(self, plan_key, now):
+        """Returns the stored plans made with plan_key that are still valid at
+        now, mapped by dataset to (valid_until, snapshots, policy kept,
+        pruneAfter kept)."""
+        rows = self.connection.execute(
+            "SELECT dataset, valid_until, snapshots, policy_kept, prune_after_kept"
+            " FROM plans"
+            " WHERE plan_key = ? AND (valid_until IS NULL OR valid_until > ?)",
+            (plan_key, now),
+        )
+        return {dataset: tuple(plan) for dataset, *plan in rows}
+
+    def store_plans(self, plan_key, plans):
+        """Records plans that pruned nothing, so unchanged datasets can skip
+        listing and planning until valid_until.
+
+        plans maps each dataset to (valid_until, snapshots, policy kept,
+        pruneAfter kept).
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO plans (dataset, plan_key, valid_until,"
+                " snapshots, policy_kept, prune_after_kept) VALUES (?, ?, ?, ?, ?, ?)",
+                ((dataset, plan_key, *plan) for dataset, plan in plans.items()),
+            )
+
+    def refresh(self, paths, properties=(), reusable_plans=None):
+        """Brings the cache up to date for the datasets under paths.
+
+        Yields (dataset, snapshot name, creation epoch, index, values)
+        records for every cached snapshot, in the same form as a listing.
+        Unchanged datasets with an entry in reusable_plans are neither
+        listed nor yielded, and are recorded in self.reused instead.
+        """
+        import subprocess
+
+        reusable_plans = reusable_plans or {}
+        self.reused = {}
+        listed_at = int(systime())
+        recorded = {}
+        for path in paths:
+            recorded.update(self.fingerprints(path))
+        try:
+            current = self._list_fingerprints(paths)
+        except subprocess.CalledProcessError:
+            # snapshots_changed needs OpenZFS 2.2, so fall back to a full listing
+            current = None
+
+        if current is None:
+            listed = {}
+            for record in _iter_listed_snapshots(paths, ("guid",)):
+                listed.setdefault(record[0], []).append(self._row(*record))
+            current = dict.fromkeys(listed)
+            self._store(listed, current, listed_at)
+        else:
+            stale = [
+                dataset
+                for dataset, changed in current.items()
+                if changed is None or recorded.get(dataset) != changed
+            ]
+            self.reused = {
+                dataset: reusable_plans[dataset]
+                for dataset, changed in current.items()
+                if dataset in reusable_plans
+                and changed is not None
+                and recorded.get(dataset) == changed
+            }
+            if len(stale) > len(current) * self.FULL_LISTING_RATIO:
+                listing = _iter_listed_snapshots(paths, ("guid",))
+            else:
+                listing = (
+                    record
+                    for chunk in _chunk_names(stale, destroy_arg_limit())
+                    for record in _iter_listed_snapshots(chunk, ("guid",), depth=1)
+                )
+            listed = {dataset: [] for dataset in stale}
+            for record in listing:
+                if record[0] in listed:
+                    listed[record[0]].append(self._row(*record))
+            self._store(listed, current, listed_at)
+
+        removed = set(recorded) - set(current)
+        if removed:
+            with self.connection:
+                for dataset in removed:
+                    self._delete(dataset)
+
+        for dataset in current:
+            if dataset in self.reused:
+                continue
+            rows = self.connection.execute(
+                "SELECT name, creation, position, guid FROM snapshots"
+                " WHERE dataset = ? ORDER BY position",
+                (dataset,),
+            )
+            for snapshot_name, creation, index, guid in rows:
+                values = [_unsigned64(guid)] if properties else []
+                yield dataset, snapshot_name, creation, index, values
+
+    def _list_fingerprints(self, paths):
+        current = {}
+        lines = _zfs_output_lines(dataset_list_command(paths, ["snapshots_changed"]))
         for line in lines:
-            name, creation_epoch = line.strip().split()
-            if f"@{identifier}" in name:
-                if skip_parent and name.split("@")[0] == path:
-                    continue
-                creation_time = datetime.fromtimestamp(int(creation_epoch))
-                snapshots.append(Snapshot(name, creation_time))
-        return snapshots
+            if not line.strip():
+                continue
+            dataset, changed = line.rstrip("\n").split("\t")
+            current[dataset] = int(changed) if changed.isdigit() else None
+        return current
+
+    @staticmethod
+    def _row(dataset, snapshot_name, creation, index, values):
+        return dataset, _signed64(values[0]), snapshot_name, creation, index
+
+    def _store(self, listed, current, listed_at):
+        with self.connection:
+            for dataset, rows in listed.items():
+                self._delete(dataset)
+                self.connection.executemany(
+                    "INSERT INTO snapshots (dataset, guid, name, creation, position)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+                changed = current[dataset]
+                # snapshots_changed has one second resolution, so a change
+                # within the second of listing may not have been seen yet
+                if changed is not None and changed >= listed_at - 1:
+                    changed = None
+                self.connection.execute(
+                    "INSERT INTO datasets (name, snapshots_changed) VALUES (?, ?)",
+                    (dataset, changed),
+                )
+
+    def _delete(self, dataset):
+        self.connection.execute("DELETE FROM plans WHERE dataset = ?", (dataset,))
+        self.connection.execute("DELETE FROM snapshots WHERE dataset = ?", (dataset,))
+        self.connection.execute("DELETE FROM datasets WHERE name = ?", (dataset,))
+
+
+def get_snapshots(path, identifier, skip_parent=False, properties=()):
+    """Lists ZFS snapshots for a given path and filters by identifier."""
+    import subprocess
+
+    try:
+        return list(iter_snapshots(path, identifier, skip_parent, properties))
     except FileNotFoundError:
         print("Error: 'zfs' command not found. Is ZFS installed and in your PATH?")
         return []
     except subprocess.CalledProcessError as e:
         print(f"Error listing snapshots for {path}: {e.stderr}")
         return []
+    except ValueError as e:
+        print(f"Error listing snapshots for {path}: {e}")
+        return []
 
 
-def destroy_snapshot(snapshot_name, dry_run=False):
-    """Destroys a ZFS snapshot."""
+def destroy_snapshot(snapshot_name, dry_run=False, log=print):
+    """Destroys a ZFS snapshot. Returns an error message, or None on success."""
     if dry_run:
-        print(f"DRY RUN: Would destroy snapshot {snapshot_name}")
-        return
+        log(f"DRY RUN: Would destroy snapshot {snapshot_name}")
+        return None
 
-    print(f"Destroying snapshot {snapshot_name}")
-    cmd = ["zfs", "destroy", snapshot_name]
+    log(f"Destroying snapshot {snapshot_name}")
+    error = _run_destroy(snapshot_name)
+    if error is not None:
+        log(f"Error destroying snapshot {snapshot_name}: {error}")
+    return error
+
+
+def _run_destroy(argument):
+    """Runs `zfs destroy` on an argument, returning stderr on failure."""
+    import subprocess
+
+    cmd = ["zfs", "destroy", argument]
     try:
         subprocess.run(cmd, check=True, capture_output=True, text=True)
     except subprocess.CalledProcessError as e:
-        print(f"Error destroying snapshot {snapshot_name}: {e.stderr}")
+        return e.stderr
+    return None
+
+
+def destroy_arg_limit():
+    """The longest `zfs destroy` argument that can safely be passed to exec."""
+    try:
+        arg_max = os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        arg_max = MAX_ARG_STRLEN
+    # Leave room for the environment and the rest of the command line
+    return min(arg_max // 2, MAX_ARG_STRLEN) - 1
+
+
+def plan_destroy_batches(snapshots, max_length=None):
+    """Groups snapshots into batched `zfs destroy` arguments, one dataset per batch.
+
+    Yields (argument, snapshot_names) tuples, where argument takes the form
+    `dataset@a,b,c` and never exceeds max_length bytes. A run of three or more
+    snapshots that are adjacent in the dataset's listing collapses into a
+    `dataset@first%last` range, which destroys everything in between.
+    """
+    if max_length is None:
+        max_length = destroy_arg_limit()
+
+    by_dataset = {}
+    for snapshot in snapshots:
+        dataset = snapshot.name.split("@")[0]
+        by_dataset.setdefault(dataset, []).append(snapshot)
+
+    for dataset, dataset_snapshots in by_dataset.items():
+        # Ranges are only safe when every position in the run is known
+        use_ranges = all(s.index is not None for s in dataset_snapshots)
+        if use_ranges:
+            dataset_snapshots = sorted(dataset_snapshots, key=lambda s: s.index)
+
+        tokens = []
+        run = []
+        for snapshot in dataset_snapshots:
+            if run and (not use_ranges or snapshot.index != run[-1].index + 1):
+                tokens.extend(_destroy_tokens(run))
+                run = []
+            run.append(snapshot)
+        tokens.extend(_destroy_tokens(run))
+
+        prefix = f"{dataset}@"
+        batch = []
+        names = []
+        length = len(prefix.encode())
+        for token, token_names in tokens:
+            token_length = len(token.encode()) + (1 if batch else 0)
+            if batch and length + token_length > max_length:
+                yield prefix + ",".join(batch), names
+                batch = []
+                names = []
+                length = len(prefix.encode())
+                token_length -= 1
+            batch.append(token)
+            names.extend(token_names)
+            length += token_length
+        if batch:
+            yield prefix + ",".join(batch), names
+
+
+def _destroy_tokens(run):
+    """Converts a run of adjacent snapshots into destroy list entries."""
+    short_names = [s.name.split("@", 1)[1] for s in run]
+    if len(run) >= 3:
+        return [(f"{short_names[0]}%{short_names[-1]}", [s.name for s in run])]
+    return [(short_name, [s.name]) for short_name, s in zip(short_names, run)]
+
+
+def channel_program_command(pool, script_path, snapshot_names):
+    """Builds the `zfs program` command line destroying snapshot_names."""
+    return [
+        "zfs",
+        "program",
+        "-j",
+        "-t",
+        str(CHANNEL_PROGRAM_INSTRUCTION_LIMIT),
+        "-m",
+        str(CHANNEL_PROGRAM_MEMORY_LIMIT),
+        pool,
+        script_path,
+        *snapshot_names,
+    ]
+
+
+def _chunk_names(names, max_length):
+    """Splits names into chunks whose combined length stays under max_length."""
+    chunk = []
+    length = 0
+    for name in names:
+        name_length = len(name.encode()) + 1
+        if chunk and length + name_length > max_length:
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(name)
+        length += name_length
+    if chunk:
+        yield chunk
+
+
+def destroy_with_channel_program(dataset, snapshot_names, log=print):
+    """Destroys a dataset's snapshots with a ZFS channel program.
+
+    Each chunk of snapshots is destroyed atomically in one `zfs program`
+    call. Returns the names that were destroyed; on any failure the
+    remaining snapshots are left for the caller to destroy another way.
+    """
+    import json
+    import subprocess
+    import tempfile
+
+    pool = dataset.split("/")[0]
+    destroyed = []
+    with tempfile.NamedTemporaryFile("w", prefix="keepoid-", suffix=".lua") as script:
+        script.write(CHANNEL_PROGRAM)
+        script.flush()
+        # Arguments share the ARG_MAX budget rather than the per-string limit
+        for chunk in _chunk_names(snapshot_names, destroy_arg_limit()):
+            cmd = channel_program_command(pool, script.name, chunk)
+            try:
+                result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+                failed = json.loads(result.stdout)["return"]
+            except subprocess.CalledProcessError as e:
+                log(f"Channel program failed for {dataset}, falling back: {e.stderr}")
+                break
+            except (ValueError, KeyError, TypeError):
+                log(f"Unexpected channel program output for {dataset}, falling back")
+                break
+            if failed:
+                log(
+                    f"Channel program could not destroy {len(failed)} snapshots on {dataset}, falling back"
+                )
+                break
+            for name in chunk:
+                log(f"Destroying snapshot {name}")
+            destroyed.extend(chunk)
+    return destroyed
+
+
+def destroy_snapshots(snapshots, dry_run=False, log=print, channel_program=False):
+    """Destroys ZFS snapshots in batches, one `zfs destroy` per batch.
+
+    With channel_program set, each dataset's snapshots are first destroyed
+    with `zfs program`, falling back to `zfs destroy` for any that remain.
+    Returns a dict mapping each snapshot name to an error message, or None if
+    it was destroyed.
+    """
+    results = {}
+    if channel_program and not dry_run:
+        remaining = []
+        for dataset, dataset_snapshots in group_snapshots_by_dataset(snapshots).items():
+            names = [s.name for s in dataset_snapshots]
+            destroyed = set(destroy_with_channel_program(dataset, names, log=log))
+            results.update(dict.fromkeys(destroyed))
+            remaining.extend(s for s in dataset_snapshots if s.name not in destroyed)
+        snapshots = remaining
+
+    for argument, names in plan_destroy_batches(snapshots):
+        if dry_run:
+            for name in names:
+                results[name] = destroy_snapshot(name, dry_run=True, log=log)
+            continue
+
+        for name in names:
+            log(f"Destroying snapshot {name}")
+        error = _run_destroy(argument)
+        if error is None:
+            results.update(dict.fromkeys(names))
+            continue
+
+        if len(names) == 1:
+            log(f"Error destroying snapshot {names[0]}: {error}")
+            results[names[0]] = error
+            continue
+
+        # Retry one at a time to find out which snapshots the batch failed on
+        for name in names:
+            error = _run_destroy(name)
+            if error is not None and "could not find any snapshots" in error:
+                # Destroyed by the batch before it failed
+                error = None
+            if error is not None:
+                log(f"Error destroying snapshot {name}: {error}")
+            results[name] = error
+    return results
+
+
+def _destroy_dataset(dataset_snapshots, dry_run, channel_program):
+    lines = []
+    started = perf_counter()
+    results = destroy_snapshots(
+        dataset_snapshots,
+        dry_run=dry_run,
+        log=lines.append,
+        channel_program=channel_program,
+    )
+    return lines, results, perf_counter() - started
+
+
+def destroy_snapshots_parallel(
+    snapshots,
+    dry_run=False,
+    jobs=1,
+    jobs_per_pool=1,
+    channel_program=False,
+    timings=None,
+):
+    """Destroys snapshots for several datasets at once.
+
+    Up to `jobs` datasets are destroyed concurrently, with no more than
+    `jobs_per_pool` of them on any one pool. Output for each dataset is
+    buffered and printed in dataset order, so logs read the same regardless
+    of which destroys finish first. Returns the same mapping as
+    destroy_snapshots. If timings is a dict, the seconds spent destroying on
+    each dataset are added to it.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    snapshots_by_dataset = group_snapshots_by_dataset(snapshots)
+    datasets = list(snapshots_by_dataset)
+
+    pending = {}
+    for position, dataset in enumerate(datasets):
+        pending.setdefault(dataset.split("/")[0], []).append(position)
+    for queue in pending.values():
+        queue.reverse()
+    running = dict.fromkeys(pending, 0)
+
+    jobs = max(jobs, 1)
+    jobs_per_pool = max(jobs_per_pool, 1)
+    outputs = {}
+    results = {}
+    next_output = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        in_flight = {}
+        while pending or in_flight:
+            # Round-robin across pools so one large pool can't starve the rest
+            submitted = True
+            while submitted and len(in_flight) < jobs:
+                submitted = False
+                for pool, queue in list(pending.items()):
+                    if len(in_flight) >= jobs:
+                        break
+                    if running[pool] >= jobs_per_pool:
+                        continue
+                    position = queue.pop()
+                    if not queue:
+                        del pending[pool]
+                    dataset_snapshots = snapshots_by_dataset[datasets[position]]
+                    future = executor.submit(
+                        _destroy_dataset, dataset_snapshots, dry_run, channel_program
+                    )
+                    in_flight[future] = (pool, position)
+                    running[pool] += 1
+                    submitted = True
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                pool, position = in_flight.pop(future)
+                running[pool] -= 1
+                outputs[position] = future.result()
+
+            while next_output in outputs:
+                lines, dataset_results, seconds = outputs.pop(next_output)
+                for line in lines:
+                    print(line)
+                results.update(dataset_results)
+                if timings is not None:
+                    dataset = datasets[next_output]
+                    timings[dataset] = timings.get(dataset, 0) + seconds
+                next_output += 1
+
+    return results
+
+
+def report_destroy_errors(results):
+    """Prints a summary of snapshots that failed to be destroyed."""
+    failed = {name: error for name, error in results.items() if error is not None}
+    if not failed:
+        return
+    print(f"Failed to destroy {len(failed)} of {len(results)} snapshots:")
+    for name, error in failed.items():
+        print(f"  {name}: {error.strip()}")
+
+
+def resolve_slot(creation_times, slot_start):
+    """Returns the index of the snapshot retained for a slot starting at slot_start.
+
+    creation_times must be sorted in ascending order. The earliest snapshot at
+    or after the slot start is preferred, falling back to the latest snapshot
+    before it. Returns None when there are no snapshots.
+    """
+    idx = bisect.bisect_left(creation_times, slot_start)
+    if idx < len(creation_times):
+        return idx
+    if idx == 0:
+        return None
+    # Prefer the earliest of any snapshots sharing the latest creation time
+    return bisect.bisect_left(creation_times, creation_times[idx - 1])
+
+
+class Policy(NamedTuple):
+    """A retention policy, normalized to whole seconds."""
+
+    interval: int
+    # Slots to retain, including the extra slot that keeps the full window
+    slots: int
+    # Offset of the schedule anchor from midnight
+    start: int
+    path: Optional[str] = None
+    # Whether the policy also applies to every descendant of path
+    recursive: bool = False
+
+
+def compile_policy(policy, global_start_time_str) -> Policy:
+    """Converts a retention policy from the config into a Policy."""
+    interval = parse_duration(policy["interval"]) // ONE_SECOND
+    start_time = time.fromisoformat(policy.get("startTime", global_start_time_str))
+    start = start_time.hour * 3600 + start_time.minute * 60 + start_time.second
+    # Add 1 to ensure backup window falls within available backups
+    return Policy(
+        interval,
+        policy["count"] + 1,
+        start,
+        policy.get("path"),
+        bool(policy.get("recursive", False)),
+    )
+
+
+def last_slot_boundary(policy: Policy, now: int) -> int:
+    """Returns the last slot boundary of a policy at or before now."""
+    # Base anchor for schedule (the first possible boundary on or before now)
+    anchor = now - now % SECONDS_PER_DAY + policy.start
+    if anchor > now:
+        anchor -= SECONDS_PER_DAY
+    return anchor + (now - anchor) // policy.interval * policy.interval
+
+
+def next_slot_boundary(policy: Policy, now: int) -> int:
+    """Returns the first slot boundary of a policy after now.
+
+    Slots restart from the policy's start time every day, so when the
+    interval does not divide a day the next boundary may be the next day's
+    start rather than the last boundary plus one interval.
+    """
+    boundary = last_slot_boundary(policy, now) + policy.interval
+    day_start = now - now % SECONDS_PER_DAY + policy.start
+    if day_start <= now:
+        day_start += SECONDS_PER_DAY
+    return min(boundary, day_start)
+
+
+def select_kept_indices(creations, policies, now):
+    """Returns the indices of the snapshots retained by policies.
+
+    creations holds snapshot creation times sorted in ascending order, and
+    now is the current time, both as whole seconds since LOCAL_EPOCH.
+    """
+    kept = set()
+    if not creations:
+        return kept
+    oldest = creations[0]
+    for policy in policies:
+        interval = policy.interval
+        slot = last_slot_boundary(policy, now)
+        for _ in range(policy.slots):
+            kept.add(resolve_slot(creations, slot))
+            # Every older slot resolves to the oldest snapshot as well
+            if slot <= oldest:
+                break
+            slot -= interval
+    return kept
+
+
+def policy_slots(creations, policies, now):
+    """Returns which slot retains each snapshot kept by policies.
+
+    Takes the same arguments as select_kept_indices, and maps each index it
+    would return to the (policy, slot start) of the first slot resolving to
+    that snapshot.
+    """
+    slots = {}
+    if not creations:
+        return slots
+    oldest = creations[0]
+    for policy in policies:
+        slot = last_slot_boundary(policy, now)
+        for _ in range(policy.slots):
+            slots.setdefault(resolve_slot(creations, slot), (policy, slot))
+            if slot <= oldest:
+                break
+            slot -= policy.interval
+    return slots
+
+
+def prune_cutoff(now: datetime, prune_after: timedelta) -> int:
+    """Returns the creation time, in seconds since LOCAL_EPOCH, that snapshots
+    must be older than to be pruned."""
+    # Snapshots are pruned once more than prune_after old. Creation times are
+    # whole seconds, so rounding up keeps sub-second precision in 'now'.
+    return -((LOCAL_EPOCH - (now - prune_after)) // ONE_SECOND)
+
+
+def applicable_policies(policies, dataset_path):
+    """Filters policies down to those applying to dataset_path.
+
+    policies is either a list of Policy, or a PolicyIndex.
+    """
+    if isinstance(policies, PolicyIndex):
+        return policies.applicable(dataset_path)
+    return [
+        p
+        for p in policies
+        if p.path is None
+        or p.path == dataset_path
+        or (p.recursive and dataset_path.startswith(f"{p.path}/"))
+    ]
+
+
+class PolicyIndex(dict):
+    """Retention policies indexed by the dataset they are attached to.
+
+    Maps each path with path-specific policies to those policies, and None
+    to the global policies, all in their original order. Looking up the
+    policies applying to a dataset takes one dictionary lookup per level of
+    its path, however many policies and paths are configured.
+    """
+
+    def __init__(self, policies=()):
+        super().__init__({None: []})
+        for policy in policies:
+            self.setdefault(policy.path, []).append(policy)
+        self._order = {policy: i for i, policy in reversed(list(enumerate(policies)))}
+        # Paths with policies inherited by their descendants
+        self._inherited = {
+            path: [p for p in attached if p.recursive]
+            for path, attached in self.items()
+            if path is not None and any(p.recursive for p in attached)
+        }
+
+    def applicable(self, dataset_path):
+        """Returns the policies applying to dataset_path."""
+        found = self.get(dataset_path, [])
+        if self._inherited:
+            ancestor = dataset_path
+            while "/" in ancestor:
+                ancestor = ancestor.rpartition("/")[0]
+                found = found + self._inherited.get(ancestor, [])
+        if not found:
+            # Shared by every dataset without path-specific policies
+            return self[None]
+        return sorted([*self[None], *found], key=self._order.__getitem__)
+
+
+def plan_dataset(creations, policies, now, prune_before, engine="python"):
+    """Splits a dataset's snapshots into pruned and kept positions.
+
+    creations holds creation times in any order, as whole seconds since
+    LOCAL_EPOCH. Returns lists of positions into creations to prune, kept
+    by policy and kept by pruneAfter, each in their original order.
+    """
+    if engine == "numpy":
+        return _plan_dataset_numpy(creations, policies, now, prune_before)
+
+    order = sorted(range(len(creations)), key=creations.__getitem__)
+    sorted_creations = [creations[i] for i in order]
+    kept = {order[i] for i in select_kept_indices(sorted_creations, policies, now)}
+
+    to_prune = []
+    policy_kept = []
+    prune_after_kept = []
+    for position, creation in enumerate(creations):
+        if position in kept:
+            policy_kept.append(position)
+        elif creation < prune_before:
+            to_prune.append(position)
+        else:
+            prune_after_kept.append(position)
+    return to_prune, policy_kept, prune_after_kept
+
+
+def _plan_dataset_numpy(creations, policies, now, prune_before):
+    """plan_dataset, with every slot of every policy resolved in one pass."""
+    import numpy as np
+
+    times = np.asarray(creations, dtype=np.int64)
+    order = np.argsort(times, kind="stable")
+    sorted_times = times[order]
+    kept = np.zeros(len(times), dtype=bool)
+
+    if len(times) and policies:
+        oldest = sorted_times[0]
+        slots = []
+        for policy in policies:
+            last_slot = last_slot_boundary(policy, now)
+            # Slots past the one at or before the oldest snapshot resolve
+            # to the oldest snapshot too, so there's no need to build them
+            needed = max(-(-(last_slot - int(oldest)) // policy.interval), 0) + 1
+            count = min(policy.slots, needed)
+            slots.append(last_slot - np.arange(count, dtype=np.int64) * policy.interval)
+        slots = np.concatenate(slots)
+
+        indices = np.searchsorted(sorted_times, slots, side="left")
+        # Slots after the newest snapshot fall back to the earliest snapshot
+        # sharing the newest creation time
+        newest = np.searchsorted(sorted_times, sorted_times[-1], side="left")
+        indices[indices == len(times)] = newest
+        kept[order[indices]] = True
+
+    prunable = ~kept & (times < prune_before)
+    return (
+        np.flatnonzero(prunable).tolist(),
+        np.flatnonzero(kept).tolist(),
+        np.flatnonzero(~kept & ~prunable).tolist(),
+    )
+
+
+def resolve_engine(engine):
+    """Returns the retention engine to use, falling back to the pure Python
+    engine when NumPy isn't available."""
+    if engine == "numpy":
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            print("Warning: NumPy is not installed, using the python engine.")
+            return "python"
+    return engine
+
+
+def next_plan_change(creations, policies, now, prune_after=None):
+    """Returns the earliest time a retention plan made at now may change.
+
+    Plans change when a policy's next slot boundary passes, or when a
+    snapshot kept by pruneAfter ages past it; new or destroyed snapshots
+    aside. creations are the creation times of the snapshots the plan keeps
+    by pruneAfter alone, since policy-kept snapshots only change hands at
+    slot boundaries. All times are whole seconds since LOCAL_EPOCH, and
+    prune_after is in seconds. The result is always after now, or None if
+    the plan can never change.
+    """
+    candidates = [next_slot_boundary(p, now) for p in policies]
+    if prune_after is not None:
+        # A snapshot is pruned once more than prune_after old, which is the
+        # second after it is exactly that old
+        prune_before = now - prune_after
+        ageing = [c + prune_after + 1 for c in creations if c >= prune_before]
+        if ageing:
+            candidates.append(min(ageing))
+    return min(candidates, default=None)
+
+
+def next_change_time(dataset_snapshots, policies, now, prune_after=None):
+    """Returns the earliest datetime at which a dataset's plan may change.
+
+    dataset_snapshots is a DatasetSnapshots or a list of Snapshot, policies
+    are the compiled policies applying to the dataset, and prune_after is
+    the pruneAfter timedelta, if any. The plan made at now stays the same
+    until then, unless snapshots are created or destroyed in the meantime,
+    which cannot be predicted. Returns None if the plan can never change.
+    """
+    creations = getattr(dataset_snapshots, "creations", None)
+    if creations is None:
+        creations = [s.creation for s in dataset_snapshots]
+    now_seconds = to_seconds(now)
+    if prune_after is not None:
+        _, _, prune_after_kept = plan_dataset(
+            creations, policies, now_seconds, prune_cutoff(now, prune_after)
+        )
+        creations = [creations[i] for i in prune_after_kept]
+        prune_after //= ONE_SECOND
+    change = next_plan_change(creations, policies, now_seconds, prune_after)
+    return None if change is None else from_seconds(change)
+
+
+def plan_key(*config):
+    """Fingerprints the configuration a plan was made with."""
+    import hashlib
+    import json
+
+    encoded = json.dumps(config, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+_worker_plan_args = None
+
+
+def _init_plan_worker(policies, now, prune_before, engine):
+    global _worker_plan_args
+    _worker_plan_args = (policies, now, prune_before, engine)
+
+
+def _plan_chunk(chunk):
+    """Plans a chunk of (dataset, creations) pairs inside a worker process."""
+    policies, now, prune_before, engine = _worker_plan_args
+    results = []
+    for dataset, creations in chunk:
+        started = perf_counter()
+        plan = plan_dataset(
+            creations,
+            applicable_policies(policies, dataset),
+            now,
+            prune_before,
+            engine=engine,
+        )
+        plan = tuple(array("q", positions) for positions in plan)
+        results.append((dataset, plan, perf_counter() - started))
+    return results
+
+
+def plan_datasets(
+    snapshots_by_dataset,
+    policies,
+    now,
+    prune_before,
+    engine="python",
+    workers=1,
+    min_snapshots=PARALLEL_PLANNING_THRESHOLD,
+    timings=None,
+):
+    """Runs plan_dataset for every dataset, in worker processes for large jobs.
+
+    snapshots_by_dataset maps each dataset to its DatasetSnapshots. Planning
+    runs serially with a single worker, a single dataset, or fewer than
+    min_snapshots snapshots in total. Otherwise each worker is sent chunks
+    of datasets as packed creation time arrays. Returns a dict mapping each
+    dataset to its plan_dataset result, in the order of snapshots_by_dataset;
+    plans from workers hold arrays of positions rather than lists. If timings
+    is a dict, the seconds spent planning each dataset are added to it.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    total = sum(len(columns) for columns in snapshots_by_dataset.values())
+    plans = {}
+    if timings is None:
+        timings = {}
+    if workers <= 1 or len(snapshots_by_dataset) < 2 or total < min_snapshots:
+        for dataset, columns in snapshots_by_dataset.items():
+            started = perf_counter()
+            plans[dataset] = plan_dataset(
+                columns.creations,
+                applicable_policies(policies, dataset),
+                now,
+                prune_before,
+                engine=engine,
+            )
+            timings[dataset] = timings.get(dataset, 0) + perf_counter() - started
+        return plans
+
+    # A few chunks per worker keeps them busy without a round trip per dataset
+    chunk_size = max(total // (workers * 4), 1)
+    chunks = []
+    chunk = []
+    chunk_snapshots = 0
+    for dataset, columns in snapshots_by_dataset.items():
+        chunk.append((dataset, columns.creations))
+        chunk_snapshots += len(columns)
+        if chunk_snapshots >= chunk_size:
+            chunks.append(chunk)
+            chunk = []
+            chunk_snapshots = 0
+    if chunk:
+        chunks.append(chunk)
+
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(chunks)),
+        initializer=_init_plan_worker,
+        initargs=(policies, now, prune_before, engine),
+    ) as executor:
+        for results in executor.map(_plan_chunk, chunks):
+            for dataset, plan, seconds in results:
+                plans[dataset] = plan
+                timings[dataset] = timings.get(dataset, 0) + seconds
+    return plans
 
 
 def determine_snapshots_to_prune(
@@ -87,78 +1434,28 @@ def determine_snapshots_to_prune(
     global_start_time_str,
     now,
     dataset_path,
+    engine="python",
 ):
-    """Determines which snapshots to keep and which to prune based on policies."""
-    policy_kept_snapshots = set()
-
-    # Filter policies for the current dataset
-    applicable_policies = []
-    for policy in retention_policies:
-        policy_path = policy.get("path")
-        if policy_path is None or policy_path == dataset_path:
-            applicable_policies.append(policy)
-
-    # Pre-sort snapshots by creation time once
-    sorted_snaps = sorted(all_snapshots, key=lambda s: s.creation_time)
-
-    for policy in applicable_policies:
-        interval = parse_duration(policy["interval"])
-        # Add 1 to ensure backup window falls within available backups
-        count = policy["count"] + 1
-        start_time_str = policy.get("startTime", global_start_time_str)
-        policy_start_time = time.fromisoformat(start_time_str)
-
-        # Base anchor for schedule (the first possible boundary on or before now)
-        anchor = datetime.combine(now.date(), policy_start_time)
-        if anchor > now:
-            anchor -= timedelta(days=1)
-
-        # Last slot boundary at or before 'now'
-        slots_since_anchor = int((now - anchor) // interval)
-        last_slot = anchor + slots_since_anchor * interval
-
-        for i in range(count):
-            target_time = last_slot - i * interval
-            if target_time < datetime.min:
-                continue
-
-            # Window for this slot
-            window_start = target_time
-            window_end = target_time + interval
-
-            # 1. Prefer snapshot in [slot, slot+interval)
-            in_window = [
-                s for s in sorted_snaps if window_start <= s.creation_time < window_end
-            ]
-
-            candidate = None
-            if in_window:
-                # Earliest in window (closest to slot start)
-                candidate = min(in_window, key=lambda s: s.creation_time)
-            else:
-                # 2. Next snapshot after window_start
-                after = [s for s in sorted_snaps if s.creation_time >= window_start]
-                if after:
-                    candidate = min(after, key=lambda s: s.creation_time)
-                else:
-                    # 3. Fallback: latest snapshot before window_start
-                    before = [s for s in sorted_snaps if s.creation_time < window_start]
-                    if before:
-                        candidate = max(before, key=lambda s: s.creation_time)
-
-            if candidate:
-                policy_kept_snapshots.add(candidate)
-
-    snapshots_to_prune = []
-    prune_after_kept_snapshots = []
-    for snapshot in all_snapshots:
-        if snapshot not in policy_kept_snapshots:
-            if now - snapshot.creation_time > prune_after:
-                snapshots_to_prune.append(snapshot)
-            else:
-                prune_after_kept_snapshots.append(snapshot)
+    """Determines which snapshots to keep and which to prune based on policies.
 
-    return snapshots_to_prune, policy_kept_snapshots, prune_after_kept_snapshots
+    Snapshot creation times are whole seconds, as zfs reports them, while now
+    may have sub-second precision.
+    """
+    policies = [
+        compile_policy(policy, global_start_time_str) for policy in retention_policies
+    ]
+    to_prune, policy_kept, prune_after_kept = plan_dataset(
+        [s.creation for s in all_snapshots],
+        applicable_policies(policies, dataset_path),
+        to_seconds(now),
+        prune_cutoff(now, prune_after),
+        engine=resolve_engine(engine),
+    )
+    return (
+        [all_snapshots[i] for i in to_prune],
+        {all_snapshots[i] for i in policy_kept},
+        [all_snapshots[i] for i in prune_after_kept],
+    )
 
 
 def group_snapshots_by_dataset(snapshots):
@@ -172,10 +1469,39 @@ def group_snapshots_by_dataset(snapshots):
     return grouped
 
 
-def main():
+def build_parser():
+    import argparse
+
     parser = argparse.ArgumentParser(
         description="Keepoid: ZFS snapshot retention and pruning tool."
     )
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=COMMANDS,
+        default="run",
+        help="Prune once and exit (run), stay resident and prune at every "
+        "slot boundary (daemon), only write the prune plan (plan), or destroy "
+        "what a plan prunes (apply).",
+    )
+    parser.add_argument(
+        "plan_file",
+        nargs="?",
+        metavar="PLAN",
+        help="Plan file to apply, for the apply command.",
+    )
+    parser.add_argument(
+        "--output",
+        default="-",
+        help="File to write the plan to, for the plan command (default: "
+        "standard output).",
+    )
+    parser.add_argument(
+        "--inventory",
+        help="Plan from this `zfs list -H -p -t snapshot -o name,creation,guid "
+        "-s createtxg` output instead of listing snapshots, for the plan "
+        "command.",
+    )
     parser.add_argument(
         "--config",
         default="/etc/keepoid/keepoid.conf",
@@ -184,71 +1510,1005 @@ def main():
     parser.add_argument(
         "--dry-run", action="store_true", help="Print actions without executing them."
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of datasets to destroy snapshots on concurrently.",
+    )
+    parser.add_argument(
+        "--jobs-per-pool",
+        type=int,
+        default=1,
+        help="Maximum number of concurrent destroys on a single pool.",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="python",
+        help="Retention engine. The numpy engine vectorizes planning for large "
+        "inventories and requires NumPy.",
+    )
+    parser.add_argument(
+        "--plan-workers",
+        type=int,
+        default=0,
+        help="Number of processes to plan datasets with (default: one per CPU). "
+        "Small inventories are always planned serially.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory to keep a snapshot inventory cache in, such as "
+        "/var/cache/keepoid. Datasets whose snapshots haven't changed since "
+        "the last run are then not re-listed.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip listing and planning datasets whose snapshots haven't changed "
+        "and whose last plan is still valid. Requires --cache-dir.",
+    )
+    parser.add_argument(
+        "--channel-program",
+        action="store_true",
+        help="Destroy each dataset's snapshots atomically with `zfs program`, "
+        "falling back to `zfs destroy` if it fails.",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print the time spent in each phase, snapshot counts, the slowest "
+        "datasets and destroys per second after each run.",
+    )
+    parser.add_argument(
+        "--stats-json",
+        metavar="PATH",
+        help="Write the --stats summary as JSON to PATH after each run, or to "
+        "standard output if PATH is -.",
+    )
+    parser.add_argument(
+        "--prometheus-textfile",
+        metavar="PATH",
+        help="Write run metrics to PATH after each run, for node_exporter's "
+        "textfile collector. PATH should end in .prom.",
+    )
+    return parser
+
+
+class Target(NamedTuple):
+    """A validated retention target, normalized for planning."""
+
+    path: str
+    identifier: str
+    skip_parent: bool
+    # pruneAfter in whole seconds
+    prune_after: int
+    policies: tuple
+    policy_index: PolicyIndex
+    # How identifier is matched, one of IDENTIFIER_MATCHES
+    identifier_match: str = "prefix"
+
+
+class Config(NamedTuple):
+    """A validated configuration, normalized for planning."""
+
+    targets: tuple
+
+    @property
+    def policies(self):
+        """Every target's retention policies."""
+        return tuple(policy for target in self.targets for policy in target.policies)
+
+
+def compile_config(config) -> Config:
+    """Validates a parsed configuration file and compiles it into a Config.
+
+    A configuration either describes a single target at the top level, or
+    lists several under targets, each inheriting the top-level settings it
+    does not override. Raises ValueError describing the first problem found.
+    """
+    if not isinstance(config, dict):
+        config = {}
+    if "targets" not in config:
+        return Config((compile_target(config),))
+
+    targets = config["targets"]
+    if not isinstance(targets, list) or not targets:
+        raise ValueError("'targets' must be a list of targets.")
+    defaults = {key: value for key, value in config.items() if key != "targets"}
+    compiled = []
+    for i, target in enumerate(targets, 1):
+        if not isinstance(target, dict):
+            raise ValueError(f"Target {i} must be a mapping of settings.")
+        try:
+            compiled.append(compile_target({**defaults, **target}))
+        except ValueError as e:
+            raise ValueError(f"Target {i}: {e}") from None
+    return Config(tuple(compiled))
+
+
+def compile_target(config) -> Target:
+    """Validates a single target's settings and compiles them into a Target."""
+    if not config.get("path") or not config.get("identifier"):
+        raise ValueError("'path' and 'identifier' must be defined in the config.")
+    if config.get("pruneAfter") is None:
+        raise ValueError("'pruneAfter' must be defined in the config.")
+    try:
+        prune_after = parse_duration(config["pruneAfter"]) // ONE_SECOND
+    except (IndexError, TypeError, ValueError):
+        raise ValueError(f"Invalid pruneAfter {config['pruneAfter']!r}.") from None
+
+    identifier_match = config.get("identifierMatch", "prefix")
+    compile_identifier(config["identifier"], identifier_match)
+
+    start_time_str = config.get("startTime", "00:00")
+    policies = []
+    for policy in config.get("retention") or []:
+        try:
+            compiled = compile_policy(policy, start_time_str)
+        except (IndexError, KeyError, TypeError, ValueError):
+            compiled = None
+        if compiled is None or compiled.interval <= 0 or compiled.slots <= 0:
+            raise ValueError(
+                f"Invalid retention policy {policy!r}. Each policy needs an "
+                "interval such as '1h', a count, and an optional startTime "
+                "quoted as 'HH:MM'."
+            )
+        policies.append(compiled)
+
+    return Target(
+        config["path"],
+        config["identifier"],
+        bool(config.get("skipParent", False)),
+        prune_after,
+        tuple(policies),
+        PolicyIndex(policies),
+        identifier_match,
+    )
+
+
+def _config_to_json(config):
+    targets = []
+    for target in config.targets:
+        data = target._asdict()
+        # The index is rebuilt from the policies when loaded
+        del data["policy_index"]
+        data["policies"] = [list(policy) for policy in target.policies]
+        targets.append(data)
+    return {"targets": targets}
+
+
+def _config_from_json(data):
+    targets = []
+    for target in data["targets"]:
+        policies = tuple(Policy(*policy) for policy in target["policies"])
+        target = {**target, "policies": policies}
+        targets.append(Target(**target, policy_index=PolicyIndex(policies)))
+    return Config(tuple(targets))
+
+
+# Bumped whenever the compiled form of Config changes
+CONFIG_CACHE_VERSION = 5
+
 
+def config_cache_path(config_path):
+    """Returns the path of the compiled copy of config_path kept beside it."""
+    directory, name = os.path.split(config_path)
+    return os.path.join(directory, f".{name}.cache.json")
+
+
+def _read_config_cache(config_path):
+    """Returns the cache entry for config_path, if any."""
+    import json
+
+    try:
+        with open(config_cache_path(config_path), "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get("version") != CONFIG_CACHE_VERSION:
+        return None
+    return cached
+
+
+def _write_config_cache(config_path, digest, config):
+    """Caches the compiled form of config_path.
+
+    The cache is written atomically, and silently skipped when the config's
+    directory is not writable.
+    """
+    import json
+
+    cache_path = config_cache_path(config_path)
+    temporary = f"{cache_path}.{os.getpid()}.tmp"
+    cached = {
+        "version": CONFIG_CACHE_VERSION,
+        "sha256": digest,
+        "config": _config_to_json(config),
+    }
     try:
-        with open(args.config, "r") as f:
-            config = yaml.safe_load(f)
+        with open(temporary, "w") as f:
+            json.dump(cached, f)
+        os.replace(temporary, cache_path)
+    except OSError:
+        try:
+            os.unlink(temporary)
+        except OSError:
+            pass
+
+
+def load_config(config_path):
+    """Loads the configuration file as a Config, or returns None if invalid.
+
+    The compiled configuration is cached beside the file and reused while the
+    file's contents hash the same, which spares importing and running the YAML
+    parser and recompiling policies on every run. The file is small, so it is
+    always hashed: an edit within the filesystem's timestamp granularity keeps
+    both the size and the modification time.
+    """
+    import hashlib
+
+    try:
+        with open(config_path, "rb") as f:
+            contents = f.read()
     except FileNotFoundError:
-        print(f"Error: Configuration file not found at {args.config}")
-        return
+        print(f"Error: Configuration file not found at {config_path}")
+        return None
 
-    global_start_time_str = config.get("startTime", "00:00")
-    prune_after = parse_duration(config.get("pruneAfter"))
-    path = config.get("path")
-    skip_parent = config.get("skipParent", False)
-    identifier = config.get("identifier")
-    retention_policies = config.get("retention", [])
+    digest = hashlib.sha256(contents).hexdigest()
+    cached = _read_config_cache(config_path)
+    if cached is not None and cached["sha256"] == digest:
+        return _config_from_json(cached["config"])
 
-    if not path or not identifier:
-        print("Error: 'path' and 'identifier' must be defined in the config.")
-        return
+    import yaml
 
-    all_snapshots = get_snapshots(path, identifier, skip_parent)
-    if not all_snapshots:
-        print("No snapshots found to process.")
+    try:
+        config = compile_config(yaml.safe_load(contents))
+    except ValueError as e:
+        print(f"Error: {e}")
+        return None
+    _write_config_cache(config_path, digest, config)
+    return config
+
+
+def open_cache(cache_dir):
+    """Opens the inventory cache in cache_dir, or in memory if unset."""
+    if not cache_dir:
+        return InventoryCache(":memory:")
+    os.makedirs(cache_dir, exist_ok=True)
+    return InventoryCache(os.path.join(cache_dir, "inventory.sqlite3"))
+
+
+SLOWEST_DATASETS = 10
+
+
+def _cpu_seconds():
+    """CPU time of this process and of the children it has waited for,
+    such as `zfs` commands and planning workers."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class _PhaseTimer:
+    """Adds the wall and CPU time of a with block to a RunStats phase."""
+
+    def __init__(self, phases, name):
+        self.phases = phases
+        self.name = name
+
+    def __enter__(self):
+        self.started = (perf_counter(), _cpu_seconds())
+
+    def __exit__(self, *exc_info):
+        wall, cpu = self.phases.get(self.name, (0.0, 0.0))
+        self.phases[self.name] = (
+            wall + perf_counter() - self.started[0],
+            cpu + _cpu_seconds() - self.started[1],
+        )
+
+
+class RunStats:
+    """Timings and counts of a single run, as reported by --stats.
+
+    Phases are timed with `with stats.phase(name):`, and the seconds spent
+    planning and destroying on each dataset are summed in dataset_seconds.
+    dataset_counts maps each dataset to its snapshots, snapshots kept by
+    policy and by pruneAfter, snapshots pruned and destroys that failed.
+    """
+
+    def __init__(self):
+        self.started = datetime.now()
+        self._start = (perf_counter(), _cpu_seconds())
+        self.phases = {}
+        self.counts = {}
+        self.dataset_seconds = {}
+        self.dataset_counts = {}
+
+    def phase(self, name):
+        return _PhaseTimer(self.phases, name)
+
+    def summary(self):
+        """Returns the stats as a JSON-serializable dict."""
+        destroy_wall = self.phases.get("destroy", (0.0, 0.0))[0]
+        destroyed = self.counts.get("destroyed", 0)
+        slowest = sorted(self.dataset_seconds.items(), key=lambda item: -item[1])
+        return {
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall_seconds": perf_counter() - self._start[0],
+            "cpu_seconds": _cpu_seconds() - self._start[1],
+            "phases": {
+                name: {"wall_seconds": wall, "cpu_seconds": cpu}
+                for name, (wall, cpu) in self.phases.items()
+            },
+            "counts": dict(self.counts),
+            "destroys_per_second": (
+                destroyed / destroy_wall if destroyed and destroy_wall else None
+            ),
+            "slowest_datasets": [
+                {"dataset": dataset, "seconds": seconds}
+                for dataset, seconds in slowest[:SLOWEST_DATASETS]
+            ],
+        }
+
+
+def _write_atomically(path, chunks):
+    """Replaces the contents of path with the strings in chunks, so readers
+    never see a partially written file."""
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "w") as f:
+            f.writelines(chunks)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+
+
+def report_stats(stats, show=True, json_path=None):
+    """Prints a summary of stats, and writes them as JSON to json_path.
+
+    A json_path of "-" prints the JSON instead.
+    """
+    import json
+
+    summary = stats.summary()
+    if json_path == "-":
+        print(json.dumps(summary))
+    elif json_path:
+        _write_atomically(json_path, [json.dumps(summary, indent=2), "\n"])
+    if not show:
         return
 
-    now = datetime.now()
+    print("Run statistics:")
+    print(f"  {'phase':<10} {'wall':>10} {'cpu':>10}")
+    for name, phase in summary["phases"].items():
+        print(
+            f"  {name:<10} {phase['wall_seconds']:9.3f}s {phase['cpu_seconds']:9.3f}s"
+        )
+    print(
+        f"  {'total':<10} {summary['wall_seconds']:9.3f}s "
+        f"{summary['cpu_seconds']:9.3f}s"
+    )
+    for name, count in summary["counts"].items():
+        print(f"  {name.replace('_', ' ').capitalize()}: {count}")
+    if summary["destroys_per_second"] is not None:
+        print(f"  Destroys per second: {summary['destroys_per_second']:.1f}")
+    if summary["slowest_datasets"]:
+        print("  Slowest datasets (planning and destroying):")
+        for entry in summary["slowest_datasets"]:
+            print(f"    {entry['dataset']}: {entry['seconds']:.3f}s")
+
 
-    snapshots_by_dataset = group_snapshots_by_dataset(all_snapshots)
+DATASET_METRICS = (
+    ("keepoid_snapshots", "Snapshots of a dataset found by the last run."),
+    ("keepoid_snapshots_kept_by_policy", "Snapshots kept by a retention policy."),
+    (
+        "keepoid_snapshots_kept_by_prune_after",
+        "Snapshots kept for being newer than pruneAfter.",
+    ),
+    ("keepoid_snapshots_pruned", "Snapshots the last run planned to prune."),
+    ("keepoid_destroy_failures", "Snapshots the last run failed to destroy."),
+)
+LAST_SUCCESS_METRIC = "keepoid_last_success_timestamp_seconds"
+
+
+def _prometheus_label(value):
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+
+def _read_last_success(path):
+    """Returns the last success timestamp from a previous textfile, if any."""
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(f"{LAST_SUCCESS_METRIC} "):
+                    return float(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
 
-    all_snapshots_to_prune = []
-    all_policy_kept_snapshots = set()
-    all_prune_after_kept_snapshots = []
 
-    for dataset_path, dataset_snapshots in snapshots_by_dataset.items():
+def write_prometheus_textfile(path, stats, success):
+    """Writes the metrics of a run for node_exporter's textfile collector.
+
+    The file is replaced atomically, so the collector never scrapes a partial
+    file. When the run failed, the last success timestamp is carried over
+    from the previous file.
+    """
+    now = systime()
+    last_success = now if success else _read_last_success(path)
+    lines = []
+
+    def family(name, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+
+    for position, (name, help_text) in enumerate(DATASET_METRICS):
+        family(
+            name,
+            help_text,
+            (
+                (f"{{dataset={_prometheus_label(dataset)}}}", counts[position])
+                for dataset, counts in stats.dataset_counts.items()
+            ),
+        )
+    family(
+        "keepoid_phase_duration_seconds",
+        "Wall time of each phase of the last run.",
         (
-            snapshots_to_prune,
-            policy_kept_snapshots,
-            prune_after_kept_snapshots,
-        ) = determine_snapshots_to_prune(
-            dataset_snapshots,
-            retention_policies,
-            prune_after,
-            global_start_time_str,
-            now,
-            dataset_path,
+            (f"{{phase={_prometheus_label(phase)}}}", wall)
+            for phase, (wall, _) in stats.phases.items()
+        ),
+    )
+    summary = stats.summary()
+    family(
+        "keepoid_run_duration_seconds",
+        "Wall time of the last run.",
+        [("", summary["wall_seconds"])],
+    )
+    family(
+        "keepoid_last_run_timestamp_seconds",
+        "When the last run finished.",
+        [("", now)],
+    )
+    family(
+        "keepoid_last_run_success",
+        "Whether the last run loaded its config, listed its snapshots and "
+        "destroyed every snapshot.",
+        [("", int(success))],
+    )
+    if last_success is not None:
+        family(
+            LAST_SUCCESS_METRIC,
+            "When a run last succeeded.",
+            [("", last_success)],
         )
-        all_snapshots_to_prune.extend(snapshots_to_prune)
-        all_policy_kept_snapshots.update(policy_kept_snapshots)
-        all_prune_after_kept_snapshots.extend(prune_after_kept_snapshots)
+    _write_atomically(path, (f"{line}\n" for line in lines))
 
-    total_kept = len(all_policy_kept_snapshots) + len(all_prune_after_kept_snapshots)
 
-    print(
-        f"Found {len(all_snapshots)} snapshots across {len(snapshots_by_dataset)} datasets."
+def report_run(args, stats, success):
+    """Reports a finished run as asked for by --stats, --stats-json and
+    --prometheus-textfile."""
+    if args.stats or args.stats_json:
+        report_stats(stats, show=args.stats, json_path=args.stats_json)
+    if args.prometheus_textfile:
+        write_prometheus_textfile(args.prometheus_textfile, stats, success)
+
+
+def run_succeeded(stats):
+    """Whether the run recorded in stats succeeded: its configuration loaded,
+    its snapshots were listed and every destroy succeeded."""
+    return not any(
+        stats.counts.get(count) for count in ("config_errors", "list_errors", "failed")
     )
+
+
+def run_once(args, config, cache=None, now=None, stats=None):
+    """Runs a single pass of planning and pruning over the configured targets.
+
+    Returns the earliest time, in whole seconds since LOCAL_EPOCH, at which
+    the plan of any dataset may change, or None. Timings and counts are
+    recorded in stats, if given.
+    """
+    if now is None:
+        now = datetime.now()
+    if stats is None:
+        stats = RunStats()
+
+    now_seconds = to_seconds(now)
+    engine = resolve_engine(args.engine)
+
+    reusable_plans = None
+    if args.incremental:
+        key = plan_key(
+            *((*target[:5], target.identifier_match) for target in config.targets)
+        )
+        reusable_plans = cache.valid_plans(key, now_seconds)
+
+    with stats.phase("list"):
+        snapshots_by_target = list_target_snapshots(
+            config.targets, cache=cache, reusable_plans=reusable_plans
+        )
+    if snapshots_by_target is None:
+        stats.counts["list_errors"] = 1
+        return None
+    reused = cache.reused if cache is not None else {}
+    if not any(snapshots_by_target) and not reused:
+        print("No snapshots found to process.")
+        return None
+
+    all_snapshots_to_prune = []
+    total_snapshots = 0
+    policy_kept_count = 0
+    prune_after_kept_count = 0
+    next_change = None
+    for dataset_path, reused_plan in reused.items():
+        valid_until, snapshots, policy_kept, prune_after_kept = reused_plan
+        next_change = _earliest(next_change, valid_until)
+        total_snapshots += snapshots
+        policy_kept_count += policy_kept
+        prune_after_kept_count += prune_after_kept
+        stats.dataset_counts[dataset_path] = [*reused_plan[1:], 0, 0]
+
+    with stats.phase("plan"):
+        # Plans of each dataset, merged across the targets its snapshots belong to
+        dataset_plans = {}
+        for target, snapshots_by_dataset in zip(config.targets, snapshots_by_target):
+            plans = plan_datasets(
+                snapshots_by_dataset,
+                target.policy_index,
+                now_seconds,
+                prune_cutoff(now, timedelta(seconds=target.prune_after)),
+                engine=engine,
+                workers=args.plan_workers or os.cpu_count() or 1,
+                timings=stats.dataset_seconds,
+            )
+            for dataset_path, dataset_plan in plans.items():
+                to_prune, policy_kept, prune_after_kept = dataset_plan
+                columns = snapshots_by_dataset[dataset_path]
+                all_snapshots_to_prune.extend(columns.snapshot(i) for i in to_prune)
+                total_snapshots += len(columns)
+                policy_kept_count += len(policy_kept)
+                prune_after_kept_count += len(prune_after_kept)
+                valid_until = next_plan_change(
+                    [columns.creations[i] for i in prune_after_kept],
+                    applicable_policies(target.policy_index, dataset_path),
+                    now_seconds,
+                    target.prune_after,
+                )
+                next_change = _earliest(next_change, valid_until)
+                plan = dataset_plans.setdefault(dataset_path, [None, 0, 0, 0, 0])
+                plan[0] = _earliest(plan[0], valid_until)
+                plan[1] += len(columns)
+                plan[2] += len(policy_kept)
+                plan[3] += len(prune_after_kept)
+                plan[4] += len(to_prune)
+        if args.incremental:
+            plans_to_store = {
+                dataset: tuple(plan[:4])
+                for dataset, plan in dataset_plans.items()
+                if not plan[4]
+            }
+            if plans_to_store:
+                cache.store_plans(key, plans_to_store)
+
+    for dataset_path, plan in dataset_plans.items():
+        stats.dataset_counts[dataset_path] = [*plan[1:], 0]
+
+    total_kept = policy_kept_count + prune_after_kept_count
+    dataset_count = len(dataset_plans) + len(reused)
+
+    print(f"Found {total_snapshots} snapshots across {dataset_count} datasets.")
+    if reused:
+        print(f"Reused unexpired plans for {len(reused)} unchanged datasets.")
     print(
-        f"Keeping {total_kept} snapshots ({len(all_policy_kept_snapshots)} by policy, {len(all_prune_after_kept_snapshots)} by pruneAfter)."
+        f"Keeping {total_kept} snapshots ({policy_kept_count} by policy, {prune_after_kept_count} by pruneAfter)."
     )
     print(f"Identified {len(all_snapshots_to_prune)} snapshots to prune.")
+    stats.counts.update(
+        datasets=dataset_count,
+        snapshots=total_snapshots,
+        kept_by_policy=policy_kept_count,
+        kept_by_prune_after=prune_after_kept_count,
+        to_prune=len(all_snapshots_to_prune),
+        reused_plans=len(reused),
+    )
 
-    for snapshot in all_snapshots_to_prune:
-        destroy_snapshot(snapshot.name, dry_run=args.dry_run)
+    if cache is not None and not args.dry_run:
+        cache.invalidate({s.name.split("@")[0] for s in all_snapshots_to_prune})
+
+    with stats.phase("destroy"):
+        results = destroy_snapshots_parallel(
+            all_snapshots_to_prune,
+            dry_run=args.dry_run,
+            jobs=args.jobs,
+            jobs_per_pool=args.jobs_per_pool,
+            channel_program=args.channel_program,
+            timings=stats.dataset_seconds,
+        )
+    report_destroy_errors(results)
+    failed = 0
+    for name, error in results.items():
+        if error is not None:
+            failed += 1
+            stats.dataset_counts[name.split("@")[0]][4] += 1
+    if not args.dry_run:
+        stats.counts.update(destroyed=len(results) - failed, failed=failed)
 
     if not all_snapshots_to_prune:
         print("No snapshots to prune.")
+    return next_change
+
+
+def _plan_records(target, snapshots_by_dataset, plans, now):
+    """Yields the plan record of every snapshot of a target, by dataset in
+    listing order."""
+    for dataset, (to_prune, policy_kept, prune_after_kept) in plans.items():
+        columns = snapshots_by_dataset[dataset]
+        decisions = dict.fromkeys(to_prune, ("prune", "expired"))
+        decisions.update(dict.fromkeys(policy_kept, ("keep", "policy")))
+        decisions.update(dict.fromkeys(prune_after_kept, ("keep", "prune_after")))
+        creations = columns.creations
+        order = sorted(range(len(creations)), key=creations.__getitem__)
+        policies = applicable_policies(target.policy_index, dataset)
+        slots = policy_slots([creations[i] for i in order], policies, now)
+        slot_of = {order[i]: slot for i, slot in slots.items()}
+        guids = columns.properties["guid"]
+        for i, snapshot_name in enumerate(columns.names):
+            decision, reason = decisions[i]
+            slot = None
+            if reason == "policy":
+                policy, start = slot_of[i]
+                slot = {
+                    "interval": policy.interval,
+                    "start": from_seconds(start).isoformat(),
+                }
+            yield {
+                "dataset": dataset,
+                "snapshot": snapshot_name,
+                "guid": guids[i],
+                "decision": decision,
+                "reason": reason,
+                "slot": slot,
+            }
+
+
+def write_plan(args, config, now=None, stats=None, stdout=None):
+    """Plans every target without destroying anything.
+
+    Writes the plan to args.output, or to stdout (standard output by
+    default) for "-", as JSON
+    lines: a header with the plan version and time, then one record per
+    snapshot with its dataset, name, guid, decision ("keep" or "prune"),
+    reason ("policy", "prune_after" or "expired") and, for snapshots kept
+    by policy, the interval and start of the slot keeping it. Snapshots are
+    listed from ZFS, or read from the `zfs list` export in args.inventory.
+    Returns whether the plan was written.
+    """
+    import json
+    import sys
+
+    if now is None:
+        now = datetime.now()
+    if stats is None:
+        stats = RunStats()
+    now_seconds = to_seconds(now)
+    engine = resolve_engine(args.engine)
+
+    with stats.phase("list"):
+        if args.inventory:
+            try:
+                with open(args.inventory) as f:
+                    snapshots_by_target = list_target_snapshots(
+                        config.targets, ("guid",), lines=f
+                    )
+            except OSError as e:
+                print(f"Error: Cannot read inventory {args.inventory}: {e.strerror}")
+                return False
+        else:
+            snapshots_by_target = list_target_snapshots(config.targets, ("guid",))
+    if snapshots_by_target is None:
+        return False
+
+    def lines():
+        header = {"version": PLAN_VERSION, "created": now.isoformat(timespec="seconds")}
+        yield json.dumps(header, separators=(",", ":")) + "\n"
+        for target, snapshots_by_dataset in zip(config.targets, snapshots_by_target):
+            plans = plan_datasets(
+                snapshots_by_dataset,
+                target.policy_index,
+                now_seconds,
+                prune_cutoff(now, timedelta(seconds=target.prune_after)),
+                engine=engine,
+                workers=args.plan_workers or os.cpu_count() or 1,
+                timings=stats.dataset_seconds,
+            )
+            for dataset, (to_prune, policy_kept, prune_after_kept) in plans.items():
+                counts = stats.dataset_counts.setdefault(dataset, [0, 0, 0, 0, 0])
+                counts[0] += len(snapshots_by_dataset[dataset])
+                counts[1] += len(policy_kept)
+                counts[2] += len(prune_after_kept)
+                counts[3] += len(to_prune)
+            for record in _plan_records(
+                target, snapshots_by_dataset, plans, now_seconds
+            ):
+                yield json.dumps(record, separators=(",", ":")) + "\n"
+
+    with stats.phase("plan"):
+        if args.output == "-":
+            (stdout or sys.stdout).writelines(lines())
+        else:
+            _write_atomically(args.output, lines())
+
+    totals = [sum(column) for column in zip(*stats.dataset_counts.values())]
+    snapshots, policy_kept, prune_after_kept, to_prune, _ = totals or [0] * 5
+    stats.counts.update(
+        datasets=len(stats.dataset_counts),
+        snapshots=snapshots,
+        kept_by_policy=policy_kept,
+        kept_by_prune_after=prune_after_kept,
+        to_prune=to_prune,
+    )
+    print(
+        f"Planned {snapshots} snapshots across {len(stats.dataset_counts)} "
+        f"datasets: keeping {policy_kept + prune_after_kept}, pruning {to_prune}."
+    )
+    if args.output != "-":
+        print(f"Wrote plan to {args.output}.")
+    return True
+
+
+def _read_plan(path):
+    """Returns the snapshots a plan file prunes, as a dict mapping each
+    dataset to a dict of snapshot names and guids."""
+    import json
+
+    planned = {}
+    with open(path) as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("version") != PLAN_VERSION:
+            raise ValueError(f"unsupported plan version {header.get('version')!r}")
+        for line in f:
+            record = json.loads(line)
+            if record["decision"] == "prune":
+                by_name = planned.setdefault(record["dataset"], {})
+                by_name[record["snapshot"]] = record["guid"]
+    return planned
+
+
+def apply_plan(args, cache=None, stats=None):
+    """Destroys the snapshots a plan written by write_plan prunes.
+
+    Each snapshot is first looked up again, and skipped unless it still
+    exists with the guid recorded in the plan, so a plan never destroys a
+    snapshot that was replaced by another of the same name. Returns whether
+    the run succeeded, as by run_succeeded: every planned dataset was listed
+    and every verified snapshot destroyed.
+    """
+    import subprocess
+
+    if stats is None:
+        stats = RunStats()
+    try:
+        planned = _read_plan(args.plan_file)
+    except OSError as e:
+        print(f"Error: Cannot read plan {args.plan_file}: {e.strerror}")
+        return False
+    except (ValueError, KeyError) as e:
+        print(f"Error: Invalid plan {args.plan_file}: {e}")
+        return False
+
+    to_destroy = []
+    changed = 0
+    with stats.phase("verify"):
+        try:
+            # Plans can name more datasets than fit in one argument list
+            listed = (
+                record
+                for chunk in _chunk_names(list(planned), destroy_arg_limit())
+                for record in _iter_listed_snapshots(chunk, ("guid",), depth=1)
+            )
+            for dataset, snapshot_name, creation, index, (guid,) in listed:
+                expected = planned.get(dataset, {}).pop(snapshot_name, None)
+                if expected is None:
+                    continue
+                if expected != guid:
+                    changed += 1
+                    print(
+                        f"Skipping {dataset}@{snapshot_name}: its guid changed "
+                        "since the plan was made."
+                    )
+                    continue
+                name = f"{dataset}@{snapshot_name}"
+                to_destroy.append(Snapshot(name, local_seconds(creation), index))
+        except FileNotFoundError:
+            print("Error: 'zfs' command not found. Is ZFS installed and in your PATH?")
+            return False
+        except subprocess.CalledProcessError as e:
+            # Snapshots listed before the error were verified all the same,
+            # but the run still failed
+            print(f"Error listing planned datasets: {e.stderr}")
+            stats.counts["list_errors"] = 1
+        except ValueError as e:
+            print(f"Error listing planned datasets: {e}")
+            return False
+    missing = sum(len(names) for names in planned.values())
+
+    print(f"Verified {len(to_destroy)} planned snapshots to prune.")
+    if missing:
+        print(f"Skipping {missing} planned snapshots that no longer exist.")
+    stats.counts.update(to_prune=len(to_destroy), guid_changed=changed, missing=missing)
+    for snapshot in to_destroy:
+        dataset = snapshot.name.split("@")[0]
+        stats.dataset_counts.setdefault(dataset, [0, 0, 0, 0, 0])[3] += 1
+
+    if cache is not None and not args.dry_run:
+        cache.invalidate(set(stats.dataset_counts))
+    with stats.phase("destroy"):
+        results = destroy_snapshots_parallel(
+            to_destroy,
+            dry_run=args.dry_run,
+            jobs=args.jobs,
+            jobs_per_pool=args.jobs_per_pool,
+            channel_program=args.channel_program,
+            timings=stats.dataset_seconds,
+        )
+    report_destroy_errors(results)
+    failed = 0
+    for name, error in results.items():
+        if error is not None:
+            failed += 1
+            stats.dataset_counts[name.split("@")[0]][4] += 1
+    if not args.dry_run:
+        stats.counts.update(destroyed=len(results) - failed, failed=failed)
+    return run_succeeded(stats) and not failed
+
+
+def _earliest(*times):
+    """Returns the earliest of times that is not None, or None."""
+    return min((t for t in times if t is not None), default=None)
+
+
+def next_wakeup(policies, now):
+    """Returns the next slot boundary of any policy after now, or None."""
+    return min((next_slot_boundary(p, now) for p in policies), default=None)
+
+
+DAEMON_SIGNALS = (signal.SIGHUP, signal.SIGINT, signal.SIGTERM)
+
+
+def wait_for_signal(signals, timeout):
+    """Waits up to timeout seconds, or forever if None, for a blocked signal.
+
+    Returns its siginfo, or None if the timeout passed first.
+    """
+    if timeout is None:
+        return signal.sigwaitinfo(signals)
+    return signal.sigtimedwait(signals, timeout)
+
+
+def daemon(args, clock=datetime.now, wait=wait_for_signal):
+    """Prunes whenever a dataset's plan may change until interrupted.
+
+    Each tick sleeps until the next slot boundary of any policy, or until a
+    snapshot ages past pruneAfter if that comes first. The inventory and
+    unexpired plans stay cached between ticks, so each tick only re-lists
+    and re-plans datasets whose snapshots or plans changed. SIGHUP reloads
+    the configuration, and SIGINT or SIGTERM exit once the current tick
+    completes.
+
+    Each tick is reported as a run of its own, which excludes the time spent
+    waiting and includes loading the configuration it runs with. A tick that
+    follows a failed reload keeps the previous configuration, but is reported
+    as unsuccessful.
+    """
+    loading = RunStats()
+    with loading.phase("config"):
+        config = load_config(args.config)
+    if config is None:
+        report_run(args, loading, success=False)
+        return
+    cache = open_cache(args.cache_dir)
+    args.incremental = True
+    signal.pthread_sigmask(signal.SIG_BLOCK, DAEMON_SIGNALS)
+    try:
+        while True:
+            stats = RunStats()
+            if loading is not None:
+                stats.phases.update(loading.phases)
+                stats.counts.update(loading.counts)
+                loading = None
+            next_change = run_once(args, config, cache, now=clock(), stats=stats)
+            report_run(args, stats, success=run_succeeded(stats))
+            now = clock()
+            wakeup = _earliest(
+                next_change, next_wakeup(config.policies, to_seconds(now))
+            )
+            if wakeup is None:
+                print("No retention policies to schedule; waiting for a signal.")
+                timeout = None
+            else:
+                print(f"Next run at {from_seconds(wakeup)}.")
+                timeout = max((from_seconds(wakeup) - now).total_seconds(), 0)
+            received = wait(DAEMON_SIGNALS, timeout)
+            if received is None:
+                continue
+            if received.si_signo != signal.SIGHUP:
+                print("Exiting.")
+                return
+            print(f"Reloading configuration from {args.config}.")
+            loading = RunStats()
+            with loading.phase("config"):
+                reloaded = load_config(args.config)
+            if reloaded is None:
+                loading.counts["config_errors"] = 1
+            else:
+                config = reloaded
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, DAEMON_SIGNALS)
+        cache.close()
+
+
+def plan(args, stdout=None):
+    """Loads the configuration and writes the plan, as the plan command."""
+    stats = RunStats()
+    with stats.phase("config"):
+        config = load_config(args.config)
+    if config is None:
+        report_run(args, stats, success=False)
+        return
+    report_run(
+        args, stats, success=write_plan(args, config, stats=stats, stdout=stdout)
+    )
+
+
+def main():
+    args = build_parser().parse_args()
+
+    if args.incremental and not args.cache_dir:
+        print("Error: --incremental requires --cache-dir.")
+        return
+
+    if (args.command == "apply") != (args.plan_file is not None):
+        print("Error: A plan file must be given to apply, and only to apply.")
+        return
+
+    if args.command == "daemon":
+        daemon(args)
+        return
+
+    if args.command == "apply":
+        stats = RunStats()
+        cache = open_cache(args.cache_dir) if args.cache_dir else None
+        report_run(args, stats, success=apply_plan(args, cache, stats))
+        return
+
+    if args.command == "plan" and args.output == "-":
+        import sys
+        from contextlib import redirect_stdout
+
+        # Standard output carries the plan alone, so messages, warnings and
+        # stats are printed to standard error instead
+        stdout = sys.stdout
+        with redirect_stdout(sys.stderr):
+            plan(args, stdout)
+        return
+    if args.command == "plan":
+        plan(args)
+        return
+
+    stats = RunStats()
+    with stats.phase("config"):
+        config = load_config(args.config)
+    if config is None:
+        report_run(args, stats, success=False)
+        return
+    cache = open_cache(args.cache_dir) if args.cache_dir else None
+    run_once(args, config, cache, stats=stats)
+    report_run(args, stats, success=run_succeeded(stats))
 
 
 if __name__ == "__main__":
@@ -1,9 +1,23 @@
 import pytest
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time
+import json
+import os
 import random
 import re
+import signal
+import subprocess
+import sys
+import threading
+import time as time_module
 from pathlib import Path
-from keepoid import parse_duration, determine_snapshots_to_prune, Snapshot, group_snapshots_by_dataset
+from keepoid import parse_duration, determine_snapshots_to_prune, Snapshot, group_snapshots_by_dataset, resolve_slot
+from keepoid import destroy_snapshots, destroy_snapshots_parallel, get_snapshots, plan_destroy_batches
+from keepoid import CHANNEL_PROGRAM, channel_program_command, iter_snapshots, parse_snapshot_line
+from keepoid import list_snapshots_by_dataset, local_seconds
+from keepoid import DatasetSnapshots, InventoryCache, next_plan_change, plan_datasets, resolve_engine
+from keepoid import from_seconds, Policy, compile_policy, last_slot_boundary, plan_dataset, prune_cutoff, to_seconds
+from keepoid import applicable_policies, next_change_time, next_slot_boundary, policy_slots, select_kept_indices
+import keepoid
 
 now = datetime(2023, 1, 31, 0, 0, 0)
 global_start_time_str = "00:00"
@@ -451,3 +465,1487 @@ def test_real_snapshots_time_ordering(real_snapshots):
             for i in range(1, len(sorted_snaps)):
                 assert sorted_snaps[i-1].creation_time <= sorted_snaps[i].creation_time, \
                     f"Snapshots should be time-ordered in dataset {dataset}"
+
+
+def reference_determine_snapshots_to_prune(
+    all_snapshots, creation_times, retention_policies, prune_after, global_start_time_str, now, dataset_path
+):
+    """The original linear-scan implementation, kept for differential testing.
+
+    Reads the creation datetimes the snapshots were built from rather than
+    Snapshot.creation_time, so it never sees keepoid's own time conversion.
+    """
+    policy_kept_snapshots = set()
+    created = dict(zip(all_snapshots, creation_times))
+
+    applicable_policies = []
+    for policy in retention_policies:
+        policy_path = policy.get("path")
+        if policy_path is None or policy_path == dataset_path:
+            applicable_policies.append(policy)
+
+    sorted_snaps = sorted(all_snapshots, key=created.__getitem__)
+
+    for policy in applicable_policies:
+        interval = parse_duration(policy["interval"])
+        count = policy["count"] + 1
+        start_time_str = policy.get("startTime", global_start_time_str)
+        policy_start_time = time.fromisoformat(start_time_str)
+
+        anchor = datetime.combine(now.date(), policy_start_time)
+        if anchor > now:
+            anchor -= timedelta(days=1)
+
+        slots_since_anchor = int((now - anchor) // interval)
+        last_slot = anchor + slots_since_anchor * interval
+
+        for i in range(count):
+            target_time = last_slot - i * interval
+            if target_time < datetime.min:
+                continue
+
+            window_start = target_time
+            window_end = target_time + interval
+
+            in_window = [
+                s for s in sorted_snaps if window_start <= created[s] < window_end
+            ]
+
+            candidate = None
+            if in_window:
+                candidate = min(in_window, key=created.__getitem__)
+            else:
+                after = [s for s in sorted_snaps if created[s] >= window_start]
+                if after:
+                    candidate = min(after, key=created.__getitem__)
+                else:
+                    before = [s for s in sorted_snaps if created[s] < window_start]
+                    if before:
+                        candidate = max(before, key=created.__getitem__)
+
+            if candidate:
+                policy_kept_snapshots.add(candidate)
+
+    snapshots_to_prune = []
+    prune_after_kept_snapshots = []
+    for snapshot in all_snapshots:
+        if snapshot not in policy_kept_snapshots:
+            if now - created[snapshot] > prune_after:
+                snapshots_to_prune.append(snapshot)
+            else:
+                prune_after_kept_snapshots.append(snapshot)
+
+    return snapshots_to_prune, policy_kept_snapshots, prune_after_kept_snapshots
+
+
+def random_creation_times(rng, now, size):
+    """Build irregular, occasionally duplicated creation times around now.
+
+    Like the ones zfs reports, they are whole seconds, even when now is not.
+    """
+    times = []
+    whole_now = now - timedelta(microseconds=now.microsecond)
+    for _ in range(size):
+        snap_time = whole_now - timedelta(seconds=rng.randint(-3600, 90 * 86400))
+        if times and rng.random() < 0.1:
+            snap_time = times[-1]
+        times.append(snap_time)
+    return times
+
+
+def random_inventory(rng, now, size):
+    """Build a dataset with irregular, occasionally duplicated creation times"""
+    return [
+        Snapshot(f"pool/data@autosnap_{i}", snap_time)
+        for i, snap_time in enumerate(random_creation_times(rng, now, size))
+    ]
+
+
+def random_policies(rng):
+    policies = []
+    for _ in range(rng.randint(0, 4)):
+        policy = {
+            "interval": rng.choice(["30m", "1h", "6h", "1d", "7d", "30d", "90s"]),
+            "count": rng.randint(0, 40),
+        }
+        if rng.random() < 0.3:
+            policy["startTime"] = f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}"
+        if rng.random() < 0.2:
+            policy["path"] = rng.choice(["pool/data", "pool/other"])
+        policies.append(policy)
+    return policies
+
+
+def test_resolve_slot():
+    times = [10, 20, 20, 30]
+    assert resolve_slot(times, 5) == 0
+    assert resolve_slot(times, 15) == 1
+    assert resolve_slot(times, 20) == 1
+    assert resolve_slot(times, 30) == 3
+    assert resolve_slot([10, 30, 30], 31) == 1
+    assert resolve_slot([], 10) is None
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_matches_reference_implementation(seed):
+    rng = random.Random(seed)
+    current_time = now + timedelta(seconds=rng.randint(0, 86400), microseconds=rng.randint(0, 999999))
+    creation_times = random_creation_times(rng, current_time, rng.randint(0, 200))
+    snapshots = [Snapshot(f"pool/data@autosnap_{i}", t) for i, t in enumerate(creation_times)]
+    policies = random_policies(rng)
+    prune_after = timedelta(seconds=rng.choice([0, 60, 3600, 86400, 7 * 86400]))
+    start_time = rng.choice(["00:00", "06:30", "23:59"])
+
+    expected = reference_determine_snapshots_to_prune(
+        snapshots, creation_times, policies, prune_after, start_time, current_time, "pool/data"
+    )
+    actual = determine_snapshots_to_prune(
+        snapshots, policies, prune_after, start_time, current_time, "pool/data"
+    )
+
+    assert actual == expected
+
+
+FAKE_ZFS = Path(__file__).resolve().parent / "fake_zfs.py"
+
+
+@pytest.fixture
+def fake_zfs(tmp_path, monkeypatch):
+    """Puts fake_zfs.py on PATH as `zfs`, recording the argv of every call"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "zfs"
+    script.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_ZFS}" "$@"\n')
+    script.chmod(0o755)
+    log = tmp_path / "zfs.log"
+    log.touch()
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_ZFS_LOG", str(log))
+    monkeypatch.setenv("FAKE_ZFS_LISTING", str(tmp_path / "listing.txt"))
+    monkeypatch.setenv("FAKE_ZFS_DATASETS", str(tmp_path / "datasets.txt"))
+
+    def calls():
+        return [json.loads(line) for line in log.read_text().splitlines()]
+
+    calls.program = tmp_path / "zfs.log.lua"
+    return calls
+
+
+def indexed_snapshots(dataset, count):
+    return [
+        Snapshot(f"{dataset}@autosnap_{i}", now - timedelta(hours=count - i), i)
+        for i in range(count)
+    ]
+
+
+def write_listing(tmp_path, snapshots):
+    """Seeds the fake zfs with snapshots, returning a reader for what's left"""
+    listing = tmp_path / "listing.txt"
+    listing.write_text("".join(f"{s.name}\t{s.creation}\n" for s in snapshots))
+    return lambda: [line.split("\t")[0] for line in listing.read_text().splitlines()]
+
+
+def test_plan_destroy_batches_ranges():
+    snapshots = indexed_snapshots("pool/data", 8)
+    to_destroy = [snapshots[i] for i in (0, 1, 2, 3, 5, 7)] + indexed_snapshots("pool/other", 2)
+
+    batches = list(plan_destroy_batches(to_destroy))
+
+    assert batches == [
+        (
+            "pool/data@autosnap_0%autosnap_3,autosnap_5,autosnap_7",
+            [snapshots[i].name for i in (0, 1, 2, 3, 5, 7)],
+        ),
+        ("pool/other@autosnap_0,autosnap_1", ["pool/other@autosnap_0", "pool/other@autosnap_1"]),
+    ]
+
+
+def test_plan_destroy_batches_without_positions():
+    # Without listing positions, gaps are unknown and ranges must not be used
+    to_destroy = [Snapshot(f"pool/data@autosnap_{i}", now) for i in range(4)]
+
+    batches = list(plan_destroy_batches(to_destroy))
+
+    assert batches == [
+        (
+            "pool/data@autosnap_0,autosnap_1,autosnap_2,autosnap_3",
+            [s.name for s in to_destroy],
+        )
+    ]
+
+
+def test_plan_destroy_batches_length_limit():
+    snapshots = indexed_snapshots("pool/data", 200)
+    to_destroy = snapshots[::2]
+
+    batches = list(plan_destroy_batches(to_destroy, max_length=100))
+
+    assert len(batches) > 1
+    assert all(len(argument) <= 100 for argument, _ in batches)
+    assert [name for _, names in batches for name in names] == [s.name for s in to_destroy]
+
+
+def test_destroy_snapshots_batches_argv(fake_zfs, tmp_path):
+    snapshots = indexed_snapshots("pool/data", 6)
+    remaining = write_listing(tmp_path, snapshots)
+
+    results = destroy_snapshots(snapshots[:4])
+
+    assert fake_zfs() == [["destroy", "pool/data@autosnap_0%autosnap_3"]]
+    assert results == dict.fromkeys(s.name for s in snapshots[:4])
+    assert remaining() == ["pool/data@autosnap_4", "pool/data@autosnap_5"]
+
+
+def test_destroy_snapshots_reports_failures(fake_zfs, tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_ZFS_FAIL", "autosnap_1")
+    snapshots = indexed_snapshots("pool/data", 2)
+    remaining = write_listing(tmp_path, snapshots)
+
+    results = destroy_snapshots(snapshots)
+
+    assert fake_zfs() == [
+        ["destroy", "pool/data@autosnap_0,autosnap_1"],
+        ["destroy", "pool/data@autosnap_0"],
+        ["destroy", "pool/data@autosnap_1"],
+    ]
+    assert results["pool/data@autosnap_0"] is None
+    assert "dataset is busy" in results["pool/data@autosnap_1"]
+    assert remaining() == ["pool/data@autosnap_1"]
+
+
+def test_destroy_snapshots_dry_run(fake_zfs):
+    results = destroy_snapshots(indexed_snapshots("pool/data", 3), dry_run=True)
+
+    assert fake_zfs() == []
+    assert len(results) == 3
+
+
+def test_get_snapshots_records_listing_positions(fake_zfs, tmp_path):
+    (tmp_path / "listing.txt").write_text(
+        "pool/data@autosnap_a\t1000\n"
+        "pool/data@manual\t2000\n"
+        "pool/data/child@autosnap_a\t2500\n"
+        "pool/data@autosnap_b\t3000\n"
+    )
+
+    snapshots = get_snapshots("pool/data", "autosnap_")
+
+    assert [(s.name, s.index) for s in snapshots] == [
+        ("pool/data@autosnap_a", 0),
+        ("pool/data/child@autosnap_a", 0),
+        ("pool/data@autosnap_b", 2),
+    ]
+    assert fake_zfs()[0][-1] == "pool/data"
+
+
+def test_destroy_snapshots_parallel(monkeypatch, capsys):
+    lock = threading.Lock()
+    active = {}
+    peak = {}
+
+    def fake_run_destroy(argument):
+        pool = argument.split("/")[0]
+        with lock:
+            active[pool] = active.get(pool, 0) + 1
+            peak[pool] = max(peak.get(pool, 0), active[pool])
+        time_module.sleep(random.uniform(0, 0.01))
+        with lock:
+            active[pool] -= 1
+        return "dataset is busy" if "busy" in argument else None
+
+    monkeypatch.setattr(keepoid, "_run_destroy", fake_run_destroy)
+    snapshots = []
+    for pool in ("tank", "backup", "archive"):
+        for dataset in range(4):
+            snapshots.extend(indexed_snapshots(f"{pool}/ds{dataset}", 1))
+    snapshots.append(Snapshot("tank/ds0@busy", now, 5))
+
+    results = destroy_snapshots_parallel(snapshots, jobs=6, jobs_per_pool=2)
+
+    assert set(peak) == {"tank", "backup", "archive"}
+    assert max(peak.values()) <= 2
+    assert set(results) == {s.name for s in snapshots}
+    assert results["tank/ds0@busy"] == "dataset is busy"
+    # Output follows dataset order no matter which destroys finished first
+    lines = capsys.readouterr().out.splitlines()
+    destroyed = [line.split()[-1] for line in lines if line.startswith("Destroying")]
+    assert destroyed[:2] == ["tank/ds0@autosnap_0", "tank/ds0@busy"]
+    assert [name.split("@")[0] for name in destroyed[2:]] == [
+        f"{pool}/ds{dataset}"
+        for pool in ("tank", "backup", "archive")
+        for dataset in range(4)
+    ][1:]
+
+
+def test_channel_program_command():
+    cmd = channel_program_command("pool", "/tmp/prune.lua", ["pool/a@x", "pool/b@y"])
+
+    assert cmd == [
+        "zfs", "program", "-j", "-t", "10000000", "-m", "10485760",
+        "pool", "/tmp/prune.lua", "pool/a@x", "pool/b@y",
+    ]
+
+
+def test_destroy_snapshots_channel_program(fake_zfs, tmp_path):
+    snapshots = indexed_snapshots("pool/data", 3) + indexed_snapshots("tank/data", 1)
+    remaining = write_listing(tmp_path, snapshots)
+
+    results = destroy_snapshots(snapshots, channel_program=True)
+
+    calls = fake_zfs()
+    assert [call[:7] for call in calls] == [
+        ["program", "-j", "-t", "10000000", "-m", "10485760", "pool"],
+        ["program", "-j", "-t", "10000000", "-m", "10485760", "tank"],
+    ]
+    assert calls[0][8:] == [s.name for s in snapshots[:3]]
+    assert calls[1][8:] == ["tank/data@autosnap_0"]
+    assert fake_zfs.program.read_text() == CHANNEL_PROGRAM
+    assert results == dict.fromkeys(s.name for s in snapshots)
+    assert remaining() == []
+
+
+def test_destroy_snapshots_channel_program_fallback(fake_zfs, tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_ZFS_PROGRAM", "unsupported")
+    snapshots = indexed_snapshots("pool/data", 3)
+    write_listing(tmp_path, snapshots)
+
+    results = destroy_snapshots(snapshots, channel_program=True)
+
+    assert [call[0] for call in fake_zfs()] == ["program", "destroy"]
+    assert fake_zfs()[1] == ["destroy", "pool/data@autosnap_0%autosnap_2"]
+    assert results == dict.fromkeys(s.name for s in snapshots)
+
+
+def test_iter_snapshots_streams(fake_zfs, tmp_path):
+    (tmp_path / "listing.txt").write_text(
+        "".join(f"pool/data@autosnap_{i}\t{1000 + i}\n" for i in range(5))
+    )
+
+    snapshots = iter_snapshots("pool/data", "autosnap_")
+
+    first = next(snapshots)
+    assert first.name == "pool/data@autosnap_0"
+    assert first.creation_time == datetime.fromtimestamp(1000)
+    assert [s.index for s in snapshots] == [1, 2, 3, 4]
+
+
+def test_get_snapshots_listing_error(fake_zfs, tmp_path, monkeypatch, capsys):
+    (tmp_path / "listing.txt").write_text("pool/data@autosnap_a\t1000\n")
+    monkeypatch.setenv("FAKE_ZFS_FAIL", "pool/data")
+
+    assert get_snapshots("pool/data", "autosnap_") == []
+    assert "permission denied" in capsys.readouterr().out
+
+
+def test_main_malformed_listing(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text("pruneAfter: 1h\npath: pool/data\nidentifier: autosnap_\nretention: []\n")
+    (tmp_path / "listing.txt").write_text("pool/data@autosnap_a\t1000\npool/data@autosnap_b\tsoon\n")
+
+    run_main(monkeypatch, "--config", str(config))
+
+    out = capsys.readouterr().out
+    assert "Error listing snapshots for pool/data: Unexpected zfs list output" in out
+    assert "Found" not in out
+    assert [call[0] for call in fake_zfs()] == ["list"]
+    assert get_snapshots("pool/data", "autosnap_") == []
+
+
+def test_parse_snapshot_line():
+    assert parse_snapshot_line("pool/my data@autosnap_a\t1000\n") == ("pool/my data@autosnap_a", 1000)
+    assert parse_snapshot_line("pool/data@a\t1000\t42\t8192\n", ("guid", "used")) == (
+        "pool/data@a", 1000, 42, 8192
+    )
+    with pytest.raises(ValueError):
+        parse_snapshot_line("pool/data@a\t1000\n", ("guid",))
+    with pytest.raises(ValueError, match="Unexpected zfs list output"):
+        parse_snapshot_line("pool/data@a\t-\n")
+
+
+def test_get_snapshots_extra_properties(fake_zfs, tmp_path):
+    (tmp_path / "listing.txt").write_text("pool/data@autosnap_a\t1000\t1234\n")
+
+    snapshots = get_snapshots("pool/data", "autosnap_", properties=("guid",))
+
+    assert fake_zfs()[0] == [
+        "list", "-H", "-p", "-t", "snapshot", "-o", "name,creation,guid",
+        "-s", "createtxg", "-r", "pool/data",
+    ]
+    assert snapshots[0].guid == 1234
+    assert snapshots[0].used is None
+
+
+def test_snapshot_representation():
+    snapshot = Snapshot("pool/data@autosnap_a", datetime(2025, 8, 24, 22, 0, 3))
+
+    assert not hasattr(snapshot, "__dict__")
+    assert isinstance(snapshot.creation, int)
+    assert snapshot.creation_time == datetime(2025, 8, 24, 22, 0, 3)
+    assert Snapshot("pool/data@a", snapshot.creation).creation_time == snapshot.creation_time
+
+
+def test_snapshot_rejects_sub_second_creation():
+    # zfs reports creation in whole seconds; rounding finer datetimes would
+    # change pruneAfter decisions near the cutoff
+    with pytest.raises(ValueError, match="whole seconds"):
+        Snapshot("pool/data@a", datetime(2025, 8, 24, 22, 0, 3, 800000))
+
+    # Sub-second precision in now is still honoured
+    snapshot = Snapshot("pool/data@a", datetime(2023, 1, 30, 23, 0, 0))
+    to_prune, _, kept = determine_snapshots_to_prune(
+        [snapshot], [], timedelta(hours=1), "00:00", datetime(2023, 1, 31, 0, 0, 0, 700000), "pool/data"
+    )
+    assert to_prune == [snapshot]
+    to_prune, _, kept = determine_snapshots_to_prune(
+        [snapshot], [], timedelta(hours=1), "00:00", datetime(2023, 1, 31, 0, 0, 0), "pool/data"
+    )
+    assert kept == [snapshot]
+
+
+@pytest.mark.parametrize("epoch", [0, 1_700_000_000, 1_710_054_000, 1_730_613_600])
+def test_local_seconds(epoch):
+    assert Snapshot("pool/data@a", local_seconds(epoch)).creation_time == datetime.fromtimestamp(epoch)
+
+
+def test_list_snapshots_by_dataset(fake_zfs, tmp_path):
+    (tmp_path / "listing.txt").write_text(
+        "pool/data@autosnap_a\t1000\t11\n"
+        "pool/data@manual\t2000\t12\n"
+        "pool/data/child@autosnap_a\t2500\t13\n"
+        "pool/data@autosnap_b\t3000\t14\n"
+    )
+
+    by_dataset = list_snapshots_by_dataset("pool/data", "autosnap_", properties=("guid",))
+
+    assert list(by_dataset) == ["pool/data", "pool/data/child"]
+    columns = by_dataset["pool/data"]
+    assert columns.names == ["autosnap_a", "autosnap_b"]
+    assert list(columns.indexes) == [0, 2]
+    snapshot = columns.snapshot(1)
+    assert snapshot.name == "pool/data@autosnap_b"
+    assert snapshot.creation_time == datetime.fromtimestamp(3000)
+    assert snapshot.guid == 14
+
+
+def test_compile_policy():
+    assert compile_policy({"interval": "6h", "count": 4}, "01:30") == Policy(21600, 5, 5400, None)
+    assert compile_policy(
+        {"interval": "1d", "count": 1, "startTime": "16:00:05", "path": "pool/data"}, "00:00"
+    ) == Policy(86400, 2, 57605, "pool/data")
+
+
+def test_last_slot_boundary():
+    policy = compile_policy({"interval": "6h", "count": 4}, "01:00")
+    assert from_seconds(last_slot_boundary(policy, to_seconds(now))) == datetime(2023, 1, 30, 19, 0)
+    current_time = to_seconds(datetime(2023, 1, 31, 13, 0))
+    assert from_seconds(last_slot_boundary(policy, current_time)) == datetime(2023, 1, 31, 13, 0)
+
+
+def test_next_slot_boundary():
+    policy = compile_policy({"interval": "6h", "count": 4}, "01:00")
+    assert from_seconds(next_slot_boundary(policy, to_seconds(now))) == datetime(2023, 1, 31, 1, 0)
+    current_time = to_seconds(datetime(2023, 1, 31, 13, 0))
+    assert from_seconds(next_slot_boundary(policy, current_time)) == datetime(2023, 1, 31, 19, 0)
+    # Slots restart at the start time each day when the interval does not divide a day
+    policy = compile_policy({"interval": "5h", "count": 4}, "00:00")
+    current_time = to_seconds(datetime(2023, 1, 31, 21, 0))
+    assert from_seconds(next_slot_boundary(policy, current_time)) == datetime(2023, 2, 1, 0, 0)
+
+
+def test_prune_cutoff():
+    prune_after = timedelta(hours=1)
+    cutoff = datetime(2023, 1, 30, 23, 0)
+    assert prune_cutoff(now, prune_after) == to_seconds(cutoff)
+    # Sub-second precision in 'now' makes a snapshot exactly prune_after old prunable
+    assert prune_cutoff(now + timedelta(microseconds=1), prune_after) == to_seconds(cutoff) + 1
+
+
+def test_plan_dataset_positions():
+    creations = [to_seconds(now - timedelta(hours=i)) for i in (3, 0, 2, 1)]
+    policies = [compile_policy({"interval": "1h", "count": 1}, "00:00")]
+
+    to_prune, policy_kept, prune_after_kept = plan_dataset(
+        creations, policies, to_seconds(now), to_seconds(now - timedelta(minutes=150))
+    )
+
+    assert (to_prune, policy_kept, prune_after_kept) == ([0], [1, 3], [2])
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_numpy_engine_matches_python(seed):
+    pytest.importorskip("numpy")
+    rng = random.Random(seed)
+    current_time = now + timedelta(seconds=rng.randint(0, 86400), microseconds=rng.randint(0, 999999))
+    creations = [s.creation for s in random_inventory(rng, current_time, rng.randint(0, 2000))]
+    policies = [compile_policy(p, "00:00") for p in random_policies(rng) if "path" not in p]
+    prune_before = prune_cutoff(current_time, timedelta(seconds=rng.choice([0, 3600, 86400])))
+
+    expected = plan_dataset(creations, policies, to_seconds(current_time), prune_before)
+    actual = plan_dataset(
+        creations, policies, to_seconds(current_time), prune_before, engine="numpy"
+    )
+
+    assert actual == expected
+
+
+def test_numpy_engine_fallback(monkeypatch, capsys, sample_snapshots):
+    monkeypatch.setitem(sys.modules, "numpy", None)
+
+    assert resolve_engine("numpy") == "python"
+    assert "NumPy is not installed" in capsys.readouterr().out
+
+    retention_policies = [{"interval": "1h", "count": 24}]
+    expected = determine_snapshots_to_prune(
+        sample_snapshots, retention_policies, timedelta(0), "00:00", now, "pool/data"
+    )
+    actual = determine_snapshots_to_prune(
+        sample_snapshots, retention_policies, timedelta(0), "00:00", now, "pool/data", engine="numpy"
+    )
+    assert actual == expected
+
+
+def test_plan_datasets_parallel_matches_serial():
+    rng = random.Random(7)
+    snapshots_by_dataset = {}
+    for dataset in range(12):
+        columns = DatasetSnapshots(f"pool/ds{dataset}")
+        for i, snapshot in enumerate(random_inventory(rng, now, rng.randint(1, 300))):
+            columns.append(f"autosnap_{i}", snapshot.creation, i)
+        snapshots_by_dataset[columns.dataset] = columns
+    policies = [
+        compile_policy({"interval": "1h", "count": 24}, "00:00"),
+        compile_policy({"interval": "1d", "count": 30, "path": "pool/ds3"}, "00:00"),
+    ]
+    args = (snapshots_by_dataset, policies, to_seconds(now), prune_cutoff(now, timedelta(hours=6)))
+
+    serial = plan_datasets(*args)
+    parallel = plan_datasets(*args, workers=3, min_snapshots=0)
+
+    assert list(parallel) == list(serial)
+    assert {
+        dataset: tuple(list(positions) for positions in plan) for dataset, plan in parallel.items()
+    } == serial
+
+
+def listed_snapshot_calls(calls):
+    return [call for call in calls if call[:2] == ["list", "-H"] and "snapshot" in call]
+
+
+def test_inventory_cache_refreshes_changed_datasets(fake_zfs, tmp_path):
+    listing = tmp_path / "listing.txt"
+    datasets = tmp_path / "datasets.txt"
+    listing.write_text(
+        "pool/data@autosnap_a\t1000\t11\n"
+        "pool/data/a@autosnap_a\t1000\t21\n"
+        "pool/data/b@autosnap_a\t1000\t31\n"
+        "pool/data/b@autosnap_b\t2000\t18446744073709551615\n"
+    )
+    datasets.write_text("pool/data\t1000\npool/data/a\t1000\npool/data/b\t2000\n")
+    cache = InventoryCache(str(tmp_path / "inventory.sqlite3"))
+
+    first = list_snapshots_by_dataset("pool/data", "autosnap_", properties=("guid",), cache=cache)
+    assert [call[-1] for call in listed_snapshot_calls(fake_zfs())] == ["pool/data"]
+    assert list(first["pool/data/b"].properties["guid"]) == [31, 18446744073709551615]
+
+    # Only pool/data/a changed, so only it is listed again
+    listing.write_text(listing.read_text() + "pool/data/a@autosnap_b\t3000\t22\n")
+    datasets.write_text("pool/data\t1000\npool/data/a\t3000\npool/data/b\t2000\n")
+    second = list_snapshots_by_dataset("pool/data", "autosnap_", cache=cache)
+
+    refreshed = listed_snapshot_calls(fake_zfs())[1:]
+    assert refreshed == [[
+        "list", "-H", "-p", "-t", "snapshot", "-o", "name,creation,guid",
+        "-s", "createtxg", "-d", "1", "pool/data/a",
+    ]]
+    assert {dataset: columns.names for dataset, columns in second.items()} == {
+        "pool/data": ["autosnap_a"],
+        "pool/data/a": ["autosnap_a", "autosnap_b"],
+        "pool/data/b": ["autosnap_a", "autosnap_b"],
+    }
+    assert second["pool/data/b"].creations == first["pool/data/b"].creations
+
+    # An invalidated dataset is listed again even though it looks unchanged
+    cache.invalidate(["pool/data/b"])
+    list_snapshots_by_dataset("pool/data", "autosnap_", cache=cache)
+    assert listed_snapshot_calls(fake_zfs())[2][-1] == "pool/data/b"
+
+
+def test_inventory_cache_without_snapshots_changed(fake_zfs, tmp_path):
+    (tmp_path / "listing.txt").write_text("pool/data@autosnap_a\t1000\t11\n")
+    cache = InventoryCache(str(tmp_path / "inventory.sqlite3"))
+
+    for _ in range(2):
+        by_dataset = list_snapshots_by_dataset("pool/data", "autosnap_", cache=cache)
+        assert by_dataset["pool/data"].names == ["autosnap_a"]
+
+    # Without snapshots_changed every run lists everything
+    assert [call[-1] for call in listed_snapshot_calls(fake_zfs())] == ["pool/data", "pool/data"]
+
+
+def test_next_plan_change():
+    policies = [
+        compile_policy({"interval": "1d", "count": 7}, "00:00"),
+        compile_policy({"interval": "6h", "count": 4}, "01:00"),
+    ]
+    current_time = to_seconds(datetime(2023, 1, 31, 2, 30))
+    creations = [to_seconds(datetime(2023, 1, 31, 2, 0)), to_seconds(datetime(2023, 1, 30, 2, 0))]
+
+    # The 6h policy's next boundary is at 07:00
+    assert from_seconds(next_plan_change(creations, policies, current_time, 86400)) == datetime(
+        2023, 1, 31, 7, 0
+    )
+    # Unless a snapshot ages past pruneAfter first
+    assert from_seconds(next_plan_change(creations, policies, current_time, 3600)) == datetime(
+        2023, 1, 31, 3, 0, 1
+    )
+    # Snapshots already past pruneAfter are gone from the plan, and one
+    # exactly pruneAfter old is pruned a second later
+    assert next_plan_change(creations, [], current_time, 60) is None
+    assert next_plan_change(creations, [], creations[0] + 60, 60) == creations[0] + 61
+    assert next_plan_change(creations, [], current_time, 60) is None
+
+
+def test_next_change_time():
+    policies = [compile_policy({"interval": "6h", "count": 4}, "01:00")]
+    current_time = datetime(2023, 1, 31, 2, 30)
+    snapshots = [
+        Snapshot("pool/data@b", datetime(2023, 1, 30, 2, 0)),
+        Snapshot("pool/data@a", datetime(2023, 1, 31, 2, 0)),
+        Snapshot("pool/data@c", datetime(2023, 1, 31, 2, 15)),
+    ]
+    columns = DatasetSnapshots("pool/data")
+    for i, snapshot in enumerate(snapshots):
+        columns.append(snapshot.name.split("@")[1], snapshot.creation, i)
+
+    for dataset_snapshots in (snapshots, columns):
+        assert next_change_time(dataset_snapshots, policies, current_time) == datetime(2023, 1, 31, 7, 0)
+        # Only c is kept by pruneAfter rather than by the policy
+        assert next_change_time(dataset_snapshots, policies, current_time, timedelta(hours=3)) == datetime(
+            2023, 1, 31, 5, 15, 1
+        )
+    # Snapshots already past pruneAfter no longer change the plan
+    assert next_change_time(snapshots, policies, current_time, timedelta(minutes=10)) == datetime(2023, 1, 31, 7, 0)
+    assert next_change_time(snapshots, [], current_time) is None
+
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["keepoid", *args])
+    keepoid.main()
+
+
+def test_main_incremental(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text(
+        "pruneAfter: 30d\n"
+        "path: pool/data\n"
+        "identifier: autosnap_\n"
+        "retention:\n"
+        "  - interval: 1h\n"
+        "    count: 24\n"
+    )
+    created = int(datetime.now().timestamp()) - 600
+    (tmp_path / "listing.txt").write_text(
+        f"pool/data@autosnap_a\t{created}\t11\npool/data/child@autosnap_a\t{created}\t21\n"
+    )
+    (tmp_path / "datasets.txt").write_text("pool/data\t1000\npool/data/child\t1000\n")
+    args = ["--config", str(config), "--cache-dir", str(tmp_path / "cache"), "--incremental"]
+
+    run_main(monkeypatch, *args)
+    assert len(listed_snapshot_calls(fake_zfs())) == 1
+
+    # Nothing changed, so the second run only lists datasets
+    capsys.readouterr()
+    run_main(monkeypatch, *args)
+    assert len(listed_snapshot_calls(fake_zfs())) == 1
+    out = capsys.readouterr().out
+    assert "Found 2 snapshots across 2 datasets." in out
+    assert "Reused unexpired plans for 2 unchanged datasets." in out
+
+    # A dataset with new snapshots is listed and planned again
+    (tmp_path / "datasets.txt").write_text("pool/data\t1000\npool/data/child\t2000\n")
+    run_main(monkeypatch, *args)
+    assert listed_snapshot_calls(fake_zfs())[-1][-1] == "pool/data/child"
+    assert "Reused unexpired plans for 1 unchanged datasets." in capsys.readouterr().out
+
+
+class FakeSignal:
+    def __init__(self, signo):
+        self.si_signo = signo
+
+
+def test_daemon_ticks_and_reloads(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text(
+        "pruneAfter: 30d\npath: pool/data\nidentifier: autosnap_\nretention:\n  - interval: 1h\n    count: 24\n"
+    )
+    created = int(datetime(2023, 1, 31, 2, 20).timestamp())
+    (tmp_path / "listing.txt").write_text(f"pool/data@autosnap_a\t{created}\t11\n")
+    (tmp_path / "datasets.txt").write_text("pool/data\t1000\n")
+    monkeypatch.setattr(sys, "argv", ["keepoid", "daemon", "--config", str(config)])
+
+    clock = iter([datetime(2023, 1, 31, 2, 30), datetime(2023, 1, 31, 2, 30, 15)] * 3)
+    timeouts = []
+    received = iter([None, FakeSignal(signal.SIGHUP), FakeSignal(signal.SIGTERM)])
+
+    def wait(signals, timeout):
+        timeouts.append(timeout)
+        if len(timeouts) == 2:
+            config.write_text(config.read_text().replace("1h", "15m"))
+        return next(received)
+
+    args = keepoid.build_parser().parse_args()
+    keepoid.daemon(args, clock=lambda: next(clock), wait=wait)
+
+    # Sleeps until the next hourly boundary, then the next quarter hour after the reload
+    assert timeouts == [1785.0, 1785.0, 885.0]
+    out = capsys.readouterr().out
+    assert out.count("Found 1 snapshots across 1 datasets.") == 3
+    assert "Reused unexpired plans for 1 unchanged datasets." in out
+    assert "Next run at 2023-01-31 02:45:00." in out
+    assert out.endswith("Exiting.\n")
+    # Only the first tick lists snapshots; the in-memory cache serves the rest
+    assert len(listed_snapshot_calls(fake_zfs())) == 1
+    assert not signal.pthread_sigmask(signal.SIG_BLOCK, []) & set(keepoid.DAEMON_SIGNALS)
+
+
+def test_daemon_reports_each_tick(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text(
+        "pruneAfter: 30d\npath: pool/data\nidentifier: autosnap_\nretention:\n  - interval: 1h\n    count: 24\n"
+    )
+    created = int(datetime(2023, 1, 31, 2, 20).timestamp())
+    (tmp_path / "listing.txt").write_text(f"pool/data@autosnap_a\t{created}\t11\n")
+    (tmp_path / "datasets.txt").write_text("pool/data\t1000\n")
+    textfile = tmp_path / "keepoid.prom"
+    monkeypatch.setattr(
+        sys, "argv", ["keepoid", "daemon", "--config", str(config), "--prometheus-textfile", str(textfile)]
+    )
+
+    # Waiting advances the wall clock the run durations are measured with
+    elapsed = [0.0]
+    monkeypatch.setattr(keepoid, "perf_counter", lambda: elapsed[0])
+    reports = []
+    report_run = keepoid.report_run
+    monkeypatch.setattr(
+        keepoid,
+        "report_run",
+        lambda args, stats, success: (reports.append((stats.summary(), success)), report_run(args, stats, success)),
+    )
+    received = iter([None, FakeSignal(signal.SIGHUP), FakeSignal(signal.SIGTERM)])
+
+    def wait(signals, timeout):
+        elapsed[0] += timeout
+        if len(reports) == 2:
+            config.write_text("retention: []\n")
+        return next(received)
+
+    args = keepoid.build_parser().parse_args()
+    keepoid.daemon(args, clock=lambda: datetime(2023, 1, 31, 2, 30), wait=wait)
+
+    assert [summary["wall_seconds"] for summary, _ in reports] == [0.0, 0.0, 0.0]
+    assert [list(summary["phases"]) for summary, _ in reports] == [
+        ["config", "list", "plan", "destroy"],
+        ["list", "plan", "destroy"],
+        ["config", "list", "plan", "destroy"],
+    ]
+    # The tick after a failed reload runs the old config, but isn't a success
+    assert [success for _, success in reports] == [True, True, False]
+    assert reports[2][0]["counts"]["config_errors"] == 1
+    assert "Found 1 snapshots across 1 datasets." in capsys.readouterr().out
+    metrics = dict(line.rsplit(" ", 1) for line in textfile.read_text().splitlines() if not line.startswith("#"))
+    assert metrics["keepoid_run_duration_seconds"] == "0.0"
+    assert metrics["keepoid_last_run_success"] == "0"
+    assert "keepoid_last_success_timestamp_seconds" in metrics
+
+
+def test_wait_for_signal_without_timeout():
+    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGHUP])
+    try:
+        os.kill(os.getpid(), signal.SIGHUP)
+        assert keepoid.wait_for_signal([signal.SIGHUP], None).si_signo == signal.SIGHUP
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGHUP])
+
+
+def test_daemon_without_policies_waits_for_signal(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text("pruneAfter: 30d\npath: pool/data\nidentifier: autosnap_\nretention: []\n")
+    (tmp_path / "listing.txt").write_text("")
+    (tmp_path / "datasets.txt").write_text("")
+    monkeypatch.setattr(sys, "argv", ["keepoid", "daemon", "--config", str(config)])
+    timeouts = []
+
+    def wait(signals, timeout):
+        timeouts.append(timeout)
+        return FakeSignal(signal.SIGTERM)
+
+    args = keepoid.build_parser().parse_args()
+    keepoid.daemon(args, clock=lambda: datetime(2023, 1, 31, 2, 30), wait=wait)
+
+    assert timeouts == [None]
+    assert "waiting for a signal" in capsys.readouterr().out
+
+
+def test_daemon_wakes_when_snapshots_age(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text("pruneAfter: 1h\npath: pool/data\nidentifier: autosnap_\nretention:\n  - interval: 1d\n    count: 1\n")
+    kept = int(datetime(2023, 1, 31, 2, 10).timestamp())
+    created = int(datetime(2023, 1, 31, 2, 20).timestamp())
+    (tmp_path / "listing.txt").write_text(f"pool/data@autosnap_a\t{kept}\t11\npool/data@autosnap_b\t{created}\t12\n")
+    (tmp_path / "datasets.txt").write_text("pool/data\t1000\n")
+    monkeypatch.setattr(sys, "argv", ["keepoid", "daemon", "--config", str(config)])
+    timeouts = []
+
+    def wait(signals, timeout):
+        timeouts.append(timeout)
+        return FakeSignal(signal.SIGTERM)
+
+    args = keepoid.build_parser().parse_args()
+    keepoid.daemon(args, clock=lambda: datetime(2023, 1, 31, 2, 30), wait=wait)
+
+    # The second snapshot is pruned once more than an hour old, at 03:20:01,
+    # long before the next daily slot. The policy-kept one never ages out.
+    assert timeouts == [3001.0]
+    assert "Next run at 2023-01-31 03:20:01." in capsys.readouterr().out
+
+
+def test_daemon_same_second_snapshots(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text("pruneAfter: 1h\npath: pool/data\nidentifier: autosnap_\nretention:\n  - interval: 1h\n    count: 24\n")
+    # sanoid takes an hourly and a frequently snapshot in the same second
+    created = int(datetime(2023, 1, 31, 2, 0).timestamp())
+    (tmp_path / "listing.txt").write_text(
+        f"pool/data@autosnap_hourly\t{created}\t11\npool/data@autosnap_frequently\t{created}\t12\n"
+    )
+    (tmp_path / "datasets.txt").write_text("pool/data\t1000\n")
+    monkeypatch.setattr(sys, "argv", ["keepoid", "daemon", "--config", str(config)])
+    clock = iter(
+        [
+            datetime(2023, 1, 31, 3, 0, 0),
+            datetime(2023, 1, 31, 3, 0, 0, 200000),
+            datetime(2023, 1, 31, 3, 0, 1),
+            datetime(2023, 1, 31, 3, 0, 1, 200000),
+        ]
+    )
+    timeouts = []
+    received = iter([None, FakeSignal(signal.SIGTERM)])
+
+    def wait(signals, timeout):
+        timeouts.append(timeout)
+        return next(received)
+
+    args = keepoid.build_parser().parse_args()
+    keepoid.daemon(args, clock=lambda: next(clock), wait=wait)
+
+    # Exactly an hour old, the frequently snapshot is kept for one more
+    # second, and the policy-kept hourly one doesn't wake the daemon at all
+    assert timeouts == [0.8, 3598.8]
+    out = capsys.readouterr().out
+    assert "Next run at 2023-01-31 03:00:01." in out
+    assert "Next run at 2023-01-31 04:00:00." in out
+    assert [call[-1] for call in fake_zfs() if call[0] == "destroy"] == ["pool/data@autosnap_frequently"]
+
+
+def test_load_config_caches_compiled_config(tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text(
+        "startTime: '01:00'\npruneAfter: 30d\npath: pool/data\nidentifier: autosnap_\nretention:\n"
+        "  - interval: 1h\n    count: 24\n  - interval: 1d\n    count: 7\n    path: pool/data/db\n"
+    )
+    hourly = Policy(3600, 25, 3600)
+    daily = Policy(86400, 8, 3600, "pool/data/db")
+    expected = keepoid.Config(
+        (
+            keepoid.Target(
+                "pool/data", "autosnap_", False, 30 * 86400, (hourly, daily), keepoid.PolicyIndex([hourly, daily])
+            ),
+        )
+    )
+    assert keepoid.load_config(str(config)) == expected
+    assert (tmp_path / ".keepoid.conf.cache.json").exists()
+
+    # Later loads don't need PyYAML at all, even when only the mtime changed
+    monkeypatch.setitem(sys.modules, "yaml", None)
+    assert keepoid.load_config(str(config)) == expected
+    os.utime(config, ns=(0, 0))
+    assert keepoid.load_config(str(config)) == expected
+
+    # Editing the config invalidates the cache
+    monkeypatch.undo()
+    config.write_text("pruneAfter: 7d\npath: pool/other\nidentifier: autosnap_\nretention: []\n")
+    os.utime(config, ns=(0, 0))
+    assert keepoid.load_config(str(config)).targets[0].path == "pool/other"
+
+    assert keepoid.load_config(str(tmp_path / "missing.conf")) is None
+    assert "Configuration file not found" in capsys.readouterr().out
+
+
+def test_load_config_same_size_and_mtime_edit(tmp_path):
+    config = tmp_path / "keepoid.conf"
+    config.write_text("pruneAfter: 7d\npath: pool/aaaa\nidentifier: autosnap_\nretention: []\n")
+    stat = os.stat(config)
+    assert keepoid.load_config(str(config)).targets[0].path == "pool/aaaa"
+
+    # An edit within the filesystem's timestamp granularity looks untouched
+    config.write_text("pruneAfter: 7d\npath: pool/bbbb\nidentifier: autosnap_\nretention: []\n")
+    os.utime(config, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert os.stat(config).st_size == stat.st_size
+    assert keepoid.load_config(str(config)).targets[0].path == "pool/bbbb"
+
+
+@pytest.mark.parametrize(
+    "config, error",
+    [
+        ({"path": "pool/data", "pruneAfter": "1h"}, "'path' and 'identifier' must be defined"),
+        (None, "'path' and 'identifier' must be defined"),
+        ({"path": "pool/data", "identifier": "autosnap_"}, "'pruneAfter' must be defined"),
+        ({"path": "pool/data", "identifier": "autosnap_", "pruneAfter": 3600}, "Invalid pruneAfter 3600"),
+        ({"path": "pool/data", "identifier": "autosnap_", "pruneAfter": "1h", "retention": [{"interval": "1h"}]}, "Invalid retention policy"),
+        ({"path": "pool/data", "identifier": "autosnap_", "pruneAfter": "1h", "retention": [{"interval": "0h", "count": 1}]}, "Invalid retention policy"),
+        # YAML reads an unquoted 16:30 as the sexagesimal integer 990
+        ({"path": "pool/data", "identifier": "autosnap_", "pruneAfter": "1h", "startTime": 990, "retention": [{"interval": "1h", "count": 1}]}, "Invalid retention policy"),
+    ],
+)
+def test_compile_config_errors(config, error):
+    with pytest.raises(ValueError, match=re.escape(error)):
+        keepoid.compile_config(config)
+
+
+def test_compile_config_targets():
+    config = keepoid.compile_config(
+        {
+            "pruneAfter": "1h",
+            "identifier": "autosnap_",
+            "retention": [{"interval": "1h", "count": 24}],
+            "targets": [
+                {"path": "pool/data"},
+                {"path": "backup", "identifier": "syncoid_", "pruneAfter": "1d", "skipParent": True},
+                {"path": "archive", "retention": [{"interval": "1d", "count": 7}]},
+            ],
+        }
+    )
+    hourly = Policy(3600, 25, 0)
+    assert [target[:5] for target in config.targets] == [
+        ("pool/data", "autosnap_", False, 3600, (hourly,)),
+        ("backup", "syncoid_", True, 86400, (hourly,)),
+        ("archive", "autosnap_", False, 3600, (Policy(86400, 8, 0),)),
+    ]
+    assert config.policies == (hourly, hourly, Policy(86400, 8, 0))
+
+    with pytest.raises(ValueError, match="Target 2: 'path' and 'identifier' must be defined"):
+        keepoid.compile_config({"identifier": "a", "pruneAfter": "1h", "targets": [{"path": "a"}, {}]})
+    with pytest.raises(ValueError, match="'targets' must be a list"):
+        keepoid.compile_config({"targets": []})
+
+
+@pytest.mark.parametrize(
+    "identifier, match, matching, other",
+    [
+        ("autosnap_", "prefix", ["autosnap_2023", "autosnap_"], ["x_autosnap_2023", "autosnap"]),
+        ("autosnap_*_daily", "glob", ["autosnap_2023_daily"], ["autosnap_2023_daily_x", "autosnap_2023_hourly"]),
+        (r"(autosnap|syncoid)_\d+", "regex", ["autosnap_1", "syncoid_22_x"], ["manual_autosnap_1", "syncoid_x"]),
+    ],
+)
+def test_compile_identifier(identifier, match, matching, other):
+    matcher = keepoid.compile_identifier(identifier, match)
+    assert all(matcher.matches(name) for name in matching)
+    assert not any(matcher.matches(name) for name in other)
+
+
+def test_compile_identifier_errors():
+    with pytest.raises(ValueError, match="Unknown identifierMatch 'fuzzy'"):
+        keepoid.compile_identifier("autosnap_", "fuzzy")
+    with pytest.raises(ValueError, match="Invalid identifier regex"):
+        keepoid.compile_identifier("autosnap_(", "regex")
+    with pytest.raises(ValueError, match="Invalid identifier regex"):
+        keepoid.compile_config({"path": "a", "identifier": "(", "identifierMatch": "regex", "pruneAfter": "1h"})
+
+
+def test_list_target_snapshots_identifier_match(fake_zfs, tmp_path):
+    (tmp_path / "listing.txt").write_text(
+        "pool/db@autosnap_1_daily\t1700000000\npool/db@autosnap_2_hourly\t1700000000\npool/db@x_autosnap_3\t1700000000\n"
+    )
+    config = keepoid.compile_config(
+        {"path": "pool/db", "identifier": "autosnap_*_daily", "identifierMatch": "glob", "pruneAfter": "1h"}
+    )
+    by_dataset = keepoid.list_target_snapshots(config.targets)[0]
+    assert by_dataset["pool/db"].names == ["autosnap_1_daily"]
+    assert list(by_dataset["pool/db"].indexes) == [0]
+
+
+def test_listing_roots():
+    assert keepoid.listing_roots(["pool/a/b", "pool-x", "pool/a", "backup", "pool/a", "pool/a-c/d", "pool/a-c"]) == [
+        "pool-x",
+        "pool/a",
+        "backup",
+        "pool/a-c",
+    ]
+    assert keepoid.listing_roots(["pool/a", "pool"]) == ["pool"]
+
+
+def test_list_target_snapshots_overlapping_roots(fake_zfs, tmp_path):
+    (tmp_path / "listing.txt").write_text(
+        "pool/db@syncoid_a\t1700000000\npool/db@autosnap_a\t1700000000\npool/web@autosnap_a\t1700000000\n"
+    )
+    targets = [("pool/db", "syncoid_", False), ("pool", "autosnap_", False)]
+    by_target = keepoid.list_target_snapshots(targets)
+
+    # The nested root is covered by the listing of its ancestor
+    assert listed_snapshot_calls(fake_zfs())[0][-1:] == ["pool"]
+    assert {dataset: columns.names for dataset, columns in by_target[0].items()} == {"pool/db": ["syncoid_a"]}
+    assert {dataset: columns.names for dataset, columns in by_target[1].items()} == {
+        "pool/db": ["autosnap_a"],
+        "pool/web": ["autosnap_a"],
+    }
+
+
+def test_route_snapshot_records():
+    targets = [("pool", "autosnap_", True), ("pool/db", "syncoid_", False), ("pool/db", "manual_", False)]
+    records = [
+        ("pool", "autosnap_a", 0, 0, []),
+        ("pool/db", "syncoid_a", 0, 0, []),
+        ("pool/db", "manual_a", 0, 1, []),
+        # Falls back to the shorter path whose identifier matches
+        ("pool/db", "autosnap_a", 0, 2, []),
+        ("pool/db/wal", "syncoid_a", 0, 0, []),
+        ("pool/web", "syncoid_a", 0, 0, []),
+        ("pool/web", "autosnap_a", 0, 1, []),
+    ]
+    routed = [(position, dataset, name) for position, dataset, name, *_ in keepoid._route_snapshot_records(records, targets)]
+    assert routed == [
+        (1, "pool/db", "syncoid_a"),
+        (2, "pool/db", "manual_a"),
+        (0, "pool/db", "autosnap_a"),
+        (1, "pool/db/wal", "syncoid_a"),
+        (0, "pool/web", "autosnap_a"),
+    ]
+
+
+def test_policy_index():
+    hourly = Policy(3600, 25, 0)
+    db = Policy(86400, 8, 0, "pool/db")
+    weekly = Policy(604800, 5, 0)
+    index = keepoid.PolicyIndex([hourly, db, weekly])
+    assert index == {None: [hourly, weekly], "pool/db": [db]}
+    assert applicable_policies(index, "pool/db") == [hourly, db, weekly]
+    assert applicable_policies(index, "pool/other") == [hourly, weekly]
+    # Non-recursive policies don't apply to descendants
+    assert applicable_policies(index, "pool/db/child") == [hourly, weekly]
+
+
+def test_policy_index_inherited_policies():
+    hourly = Policy(3600, 25, 0)
+    backup = Policy(86400, 31, 0, "backup", recursive=True)
+    db = Policy(604800, 5, 0, "backup/db", recursive=True)
+    only_db = Policy(600, 7, 0, "backup/db")
+    policies = [db, hourly, only_db, backup]
+    index = keepoid.PolicyIndex(policies)
+
+    assert index.applicable("backup/db/pg/wal") == [db, hourly, backup]
+    assert index.applicable("backup/db") == [db, hourly, only_db, backup]
+    assert index.applicable("backup") == [hourly, backup]
+    assert index.applicable("backupdb") == [hourly]
+    assert index.applicable("tank/db") is index[None]
+    # The flat list form resolves the same way
+    for dataset in ("backup/db/pg/wal", "backup/db", "backup", "backupdb", "tank/db"):
+        assert applicable_policies(policies, dataset) == index.applicable(dataset)
+
+
+def test_compile_policy_recursive():
+    policy = compile_policy({"interval": "1d", "count": 7, "path": "backup/db", "recursive": True}, "00:00")
+    assert policy == Policy(86400, 8, 0, "backup/db", True)
+
+
+# Modules that must only be imported by the code paths that need them
+DEFERRED_MODULES = ("argparse", "concurrent.futures", "sqlite3", "subprocess", "tempfile", "yaml")
+# Ceiling for `import keepoid` with compiled bytecode, in microseconds. A
+# cold start takes 20-30 ms, but shared CI runners are noisy, so this only
+# catches gross regressions: importing the deferred modules eagerly adds
+# about 150 ms, and NumPy more. test_import_defers_modules is the exact check.
+IMPORT_TIME_LIMIT_US = 100_000
+
+
+def import_env(tmp_path):
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONDONTWRITEBYTECODE"}
+    env["PYTHONPYCACHEPREFIX"] = str(tmp_path)
+    return env
+
+
+def test_import_defers_modules(tmp_path):
+    script = f"import sys, keepoid; print([m for m in {DEFERRED_MODULES!r} if m in sys.modules])"
+    result = subprocess.run(
+        [sys.executable, "-c", script], env=import_env(tmp_path), cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
+
+
+def test_import_time_budget(tmp_path):
+    env = import_env(tmp_path)
+    cwd = Path(__file__).parent
+    # The first run compiles the bytecode
+    subprocess.run([sys.executable, "-c", "import keepoid"], env=env, cwd=cwd, check=True)
+
+    timings = []
+    for _ in range(3):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import keepoid"],
+            env=env,
+            cwd=cwd,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        line = result.stderr.strip().splitlines()[-1]
+        assert line.endswith("| keepoid")
+        timings.append(int(line.split("|")[1]))
+    assert min(timings) < IMPORT_TIME_LIMIT_US
+
+
+def test_main_multiple_targets(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text(
+        "pruneAfter: 1h\n"
+        "identifier: autosnap_\n"
+        "retention:\n"
+        "  - interval: 1d\n"
+        "    count: 1\n"
+        "targets:\n"
+        "  - path: pool/data\n"
+        "  - path: backup/db\n"
+        "    identifier: syncoid_\n"
+        "    retention: []\n"
+    )
+    created = int(datetime.now().timestamp()) - 10 * 86400
+    (tmp_path / "listing.txt").write_text(
+        f"pool/data@autosnap_a\t{created}\n"
+        f"pool/data@autosnap_b\t{created + 3600}\n"
+        f"backup/db@syncoid_a\t{created}\n"
+        f"backup/db@autosnap_a\t{created}\n"
+        f"other@autosnap_a\t{created}\n"
+    )
+
+    run_main(monkeypatch, "--config", str(config), "--dry-run")
+
+    # Both targets are served by one listing
+    assert len(listed_snapshot_calls(fake_zfs())) == 1
+    assert listed_snapshot_calls(fake_zfs())[0][-2:] == ["pool/data", "backup/db"]
+    out = capsys.readouterr().out
+    assert "Found 3 snapshots across 2 datasets." in out
+    # backup/db keeps no snapshots, and pool/data keeps its newer daily snapshot
+    assert "Keeping 1 snapshots" in out
+    assert "Identified 2 snapshots to prune." in out
+    assert "Would destroy snapshot pool/data@autosnap_a" in out
+    assert "Would destroy snapshot backup/db@syncoid_a" in out
+
+
+def test_fake_zfs_destroy_syntax(fake_zfs, tmp_path):
+    remaining = write_listing(tmp_path, indexed_snapshots("pool/data", 6) + indexed_snapshots("pool/other", 1))
+
+    subprocess.run(["zfs", "destroy", "pool/data@%autosnap_1,autosnap_3,autosnap_4%"], check=True)
+    assert remaining() == ["pool/data@autosnap_2", "pool/other@autosnap_0"]
+
+    # Missing names are skipped, but a destroy matching nothing fails
+    subprocess.run(["zfs", "destroy", "pool/data@autosnap_0,autosnap_2"], check=True)
+    result = subprocess.run(["zfs", "destroy", "pool/data@autosnap_2"], capture_output=True, text=True)
+    assert result.returncode == 1
+    assert "could not find any snapshots to destroy" in result.stderr
+    assert remaining() == ["pool/other@autosnap_0"]
+
+
+def test_fake_zfs_snapshot_depth(fake_zfs, tmp_path):
+    names = ["pool/data@a", "pool/data/child@b", "pool/data/child/grandchild@c"]
+    write_listing(tmp_path, [Snapshot(name, 0) for name in names])
+
+    def listed(depth):
+        command = ["zfs", "list", "-H", "-p", "-o", "name", "-t", "snapshot", "-d", depth, "pool/data"]
+        return subprocess.run(command, check=True, capture_output=True, text=True).stdout.split()
+
+    # As in zfs, a snapshot is one level below its dataset
+    assert listed("0") == []
+    assert listed("1") == ["pool/data@a"]
+    assert listed("2") == ["pool/data@a", "pool/data/child@b"]
+
+
+def test_main_destroys_end_to_end(fake_zfs, tmp_path, monkeypatch, capsys):
+    # Without a datasets file, snapshots_changed follows the fake zfs state
+    monkeypatch.delenv("FAKE_ZFS_DATASETS")
+    config = tmp_path / "keepoid.conf"
+    config.write_text(
+        "pruneAfter: 1h\n"
+        "path: pool/data\n"
+        "identifier: autosnap_\n"
+        "retention:\n"
+        "  - interval: 1h\n"
+        "    count: 24\n"
+    )
+    hour = int(datetime.now().replace(minute=0, second=0, microsecond=0).timestamp())
+    listing = tmp_path / "listing.txt"
+    listing.write_text("".join(f"pool/data@autosnap_{i:02d}\t{hour - (48 - i) * 3600}\n" for i in range(48)))
+    args = ["--config", str(config), "--cache-dir", str(tmp_path / "cache"), "--incremental"]
+
+    run_main(monkeypatch, *args)
+
+    destroys = [call for call in fake_zfs() if call[0] == "destroy"]
+    assert destroys == [["destroy", "pool/data@autosnap_00%autosnap_23"]]
+    assert [line.split("\t")[0] for line in listing.read_text().splitlines()] == [
+        f"pool/data@autosnap_{i:02d}" for i in range(24, 48)
+    ]
+
+    # The destroy changed the dataset, so the next run lists it again
+    capsys.readouterr()
+    run_main(monkeypatch, *args)
+    assert len(listed_snapshot_calls(fake_zfs())) == 2
+    assert "Identified 0 snapshots to prune." in capsys.readouterr().out
+
+
+def test_main_stats(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text(
+        "pruneAfter: 1h\n"
+        "path: pool\n"
+        "identifier: autosnap_\n"
+        "retention:\n"
+        "  - interval: 1d\n"
+        "    count: 1\n"
+    )
+    created = int(datetime.now().timestamp()) - 10 * 86400
+    (tmp_path / "listing.txt").write_text(
+        "".join(f"pool/{name}@autosnap_{i}\t{created + i}\n" for name in ("a", "b") for i in range(3))
+    )
+    stats_json = tmp_path / "stats.json"
+
+    run_main(monkeypatch, "--config", str(config), "--stats", "--stats-json", str(stats_json))
+
+    out = capsys.readouterr().out
+    assert "Run statistics:" in out
+    assert "Destroys per second:" in out
+    summary = json.loads(stats_json.read_text())
+    assert list(summary["phases"]) == ["config", "list", "plan", "destroy"]
+    assert all(phase["wall_seconds"] >= 0 for phase in summary["phases"].values())
+    assert summary["counts"] == {
+        "datasets": 2,
+        "snapshots": 6,
+        "kept_by_policy": 2,
+        "kept_by_prune_after": 0,
+        "to_prune": 4,
+        "reused_plans": 0,
+        "destroyed": 4,
+        "failed": 0,
+    }
+    assert summary["destroys_per_second"] > 0
+    assert {entry["dataset"] for entry in summary["slowest_datasets"]} == {"pool/a", "pool/b"}
+    assert summary["wall_seconds"] >= summary["phases"]["destroy"]["wall_seconds"]
+
+
+def test_main_prometheus_textfile(fake_zfs, tmp_path, monkeypatch):
+    config = tmp_path / "keepoid.conf"
+    config.write_text(
+        "pruneAfter: 1h\n"
+        "path: pool\n"
+        "identifier: autosnap_\n"
+        "retention:\n"
+        "  - interval: 1d\n"
+        "    count: 1\n"
+    )
+    created = int(datetime.now().timestamp()) - 10 * 86400
+    listing = "".join(f"pool/{name}@autosnap_{i}\t{created + i}\n" for name in ("a", "b") for i in range(3))
+    (tmp_path / "listing.txt").write_text(listing)
+    textfile = tmp_path / "keepoid.prom"
+
+    run_main(monkeypatch, "--config", str(config), "--prometheus-textfile", str(textfile))
+
+    metrics = dict(line.rsplit(" ", 1) for line in textfile.read_text().splitlines() if not line.startswith("#"))
+    assert metrics['keepoid_snapshots{dataset="pool/a"}'] == "3"
+    assert metrics['keepoid_snapshots_kept_by_policy{dataset="pool/b"}'] == "1"
+    assert metrics['keepoid_snapshots_kept_by_prune_after{dataset="pool/b"}'] == "0"
+    assert metrics['keepoid_snapshots_pruned{dataset="pool/a"}'] == "2"
+    assert metrics['keepoid_destroy_failures{dataset="pool/a"}'] == "0"
+    assert set(name for name in metrics if name.startswith("keepoid_phase_duration_seconds")) == {
+        f'keepoid_phase_duration_seconds{{phase="{phase}"}}' for phase in ("config", "list", "plan", "destroy")
+    }
+    assert metrics["keepoid_last_run_success"] == "1"
+    last_success = metrics["keepoid_last_success_timestamp_seconds"]
+
+    # A failed run keeps the previous success time
+    (tmp_path / "listing.txt").write_text(listing)
+    monkeypatch.setenv("FAKE_ZFS_FAIL", "pool/b")
+    run_main(monkeypatch, "--config", str(config), "--prometheus-textfile", str(textfile))
+
+    metrics = dict(line.rsplit(" ", 1) for line in textfile.read_text().splitlines() if not line.startswith("#"))
+    assert metrics['keepoid_destroy_failures{dataset="pool/b"}'] == "2"
+    assert metrics["keepoid_last_run_success"] == "0"
+    assert metrics["keepoid_last_success_timestamp_seconds"] == last_success
+    assert [path.name for path in tmp_path.iterdir() if path.name.startswith("keepoid.prom")] == ["keepoid.prom"]
+
+
+def test_main_prometheus_textfile_listing_errors(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text("pruneAfter: 1h\npath: pool\nidentifier: autosnap_\nretention:\n  - interval: 1d\n    count: 1\n")
+    created = int(datetime.now().timestamp()) - 10 * 86400
+    (tmp_path / "listing.txt").write_text(f"pool/a@autosnap_0\t{created}\n")
+    textfile = tmp_path / "keepoid.prom"
+
+    def metrics():
+        return dict(line.rsplit(" ", 1) for line in textfile.read_text().splitlines() if not line.startswith("#"))
+
+    run_main(monkeypatch, "--config", str(config), "--prometheus-textfile", str(textfile))
+    assert metrics()["keepoid_last_run_success"] == "1"
+    last_success = metrics()["keepoid_last_success_timestamp_seconds"]
+
+    # A failing `zfs list` is not a run that found no snapshots
+    monkeypatch.setenv("FAKE_ZFS_FAIL", "pool")
+    run_main(monkeypatch, "--config", str(config), "--prometheus-textfile", str(textfile))
+    assert "Error listing snapshots for pool" in capsys.readouterr().out
+    assert metrics()["keepoid_last_run_success"] == "0"
+    assert metrics()["keepoid_last_success_timestamp_seconds"] == last_success
+
+    # Neither is a missing `zfs`
+    monkeypatch.delenv("FAKE_ZFS_FAIL")
+    monkeypatch.setenv("PATH", str(tmp_path / "empty"))
+    run_main(monkeypatch, "--config", str(config), "--prometheus-textfile", str(textfile))
+    assert "'zfs' command not found" in capsys.readouterr().out
+    assert metrics()["keepoid_last_run_success"] == "0"
+    assert metrics()["keepoid_last_success_timestamp_seconds"] == last_success
+
+
+def test_policy_slots():
+    policies = [compile_policy({"interval": "1h", "count": 3}, "00:00"), compile_policy({"interval": "1d", "count": 2}, "00:00")]
+    current = to_seconds(now)
+    creations = [current - hours * 3600 for hours in (72, 50, 30, 4, 2, 1)]
+
+    slots = policy_slots(creations, policies, current)
+
+    assert set(slots) == select_kept_indices(creations, policies, current)
+    # The newest snapshot fills the current hourly and daily slots, and is
+    # attributed to the first of them
+    assert slots[5] == (policies[0], current)
+    assert slots[3] == (policies[1], current - 86400)
+    assert slots[2] == (policies[1], current - 2 * 86400)
+
+
+PLAN_CONFIG = (
+    "pruneAfter: 1h\n"
+    "path: pool\n"
+    "identifier: autosnap_\n"
+    "retention:\n"
+    "  - interval: 1d\n"
+    "    count: 1\n"
+)
+
+
+def test_plan_and_apply(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text(PLAN_CONFIG)
+    created = int(datetime.now().timestamp()) - 10 * 86400
+    listing = tmp_path / "listing.txt"
+    listing.write_text("".join(f"pool/a@autosnap_{i}\t{created + i}\t{100 + i}\n" for i in range(4)))
+    plan = tmp_path / "plan.json"
+
+    run_main(monkeypatch, "plan", "--config", str(config), "--output", str(plan))
+
+    assert [call[0] for call in fake_zfs()] == ["list"]
+    header, *records = [json.loads(line) for line in plan.read_text().splitlines()]
+    assert header["version"] == keepoid.PLAN_VERSION
+    assert [(r["snapshot"], r["guid"], r["decision"], r["reason"]) for r in records] == [
+        ("autosnap_0", 100, "prune", "expired"),
+        ("autosnap_1", 101, "prune", "expired"),
+        ("autosnap_2", 102, "prune", "expired"),
+        ("autosnap_3", 103, "keep", "policy"),
+    ]
+    assert records[0]["slot"] is None
+    assert records[3]["slot"]["interval"] == 86400
+    assert "pruning 3" in capsys.readouterr().out
+
+    # autosnap_1 was recreated and autosnap_2 destroyed since planning
+    listing.write_text(
+        f"pool/a@autosnap_0\t{created}\t100\npool/a@autosnap_1\t{created + 1}\t999\n"
+        f"pool/a@autosnap_3\t{created + 3}\t103\n"
+    )
+    run_main(monkeypatch, "apply", str(plan))
+
+    assert fake_zfs()[-1] == ["destroy", "pool/a@autosnap_0"]
+    assert [line.split("\t")[0] for line in listing.read_text().splitlines()] == [
+        "pool/a@autosnap_1", "pool/a@autosnap_3",
+    ]
+    out = capsys.readouterr().out
+    assert "Skipping pool/a@autosnap_1: its guid changed since the plan was made." in out
+    assert "Skipping 1 planned snapshots that no longer exist." in out
+
+
+def test_plan_from_inventory(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text(PLAN_CONFIG)
+    created = int(datetime.now().timestamp()) - 10 * 86400
+    inventory = tmp_path / "inventory.txt"
+    inventory.write_text(
+        f"pool/a@autosnap_0\t{created}\t100\npool/a@autosnap_1\t{created + 1}\t101\n"
+        f"other/b@autosnap_0\t{created}\t200\n"
+    )
+
+    run_main(monkeypatch, "plan", "--config", str(config), "--inventory", str(inventory))
+
+    assert fake_zfs() == []
+    header, *records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(r["dataset"], r["snapshot"], r["decision"]) for r in records] == [
+        ("pool/a", "autosnap_0", "prune"),
+        ("pool/a", "autosnap_1", "keep"),
+    ]
+
+    # Inventories must carry guids
+    inventory.write_text(f"pool/a@autosnap_0\t{created}\n")
+    run_main(monkeypatch, "plan", "--config", str(config), "--inventory", str(inventory))
+    assert "Error: Invalid inventory" in capsys.readouterr().err
+
+
+def test_plan_to_stdout_applies(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text(PLAN_CONFIG)
+    created = int(datetime.now().timestamp()) - 10 * 86400
+    listing = tmp_path / "listing.txt"
+    listing.write_text("".join(f"pool/a@autosnap_{i}\t{created + i}\t{100 + i}\n" for i in range(3)))
+    monkeypatch.setitem(sys.modules, "numpy", None)
+
+    # Like `keepoid.py plan --stats ... > plan.json`: only the plan reaches stdout
+    run_main(monkeypatch, "plan", "--config", str(config), "--stats", "--stats-json", "-", "--engine", "numpy")
+    captured = capsys.readouterr()
+    assert "NumPy is not installed" in captured.err
+    assert "Run statistics:" in captured.err
+    assert "pruning 2" in captured.err
+    plan = tmp_path / "plan.json"
+    plan.write_text(captured.out)
+
+    run_main(monkeypatch, "apply", str(plan))
+
+    assert "Error" not in capsys.readouterr().out
+    assert [line.split("\t")[0] for line in listing.read_text().splitlines()] == ["pool/a@autosnap_2"]
+
+
+def test_apply_lists_in_chunks(fake_zfs, tmp_path, monkeypatch, capsys):
+    config = tmp_path / "keepoid.conf"
+    config.write_text(PLAN_CONFIG)
+    created = int(datetime.now().timestamp()) - 10 * 86400
+    listing = tmp_path / "listing.txt"
+    listing.write_text(
+        "".join(f"pool/{name}@autosnap_{i}\t{created + i}\t{100 + i}\n" for name in ("a", "b", "gone") for i in range(2))
+    )
+    plan = tmp_path / "plan.json"
+    run_main(monkeypatch, "plan", "--config", str(config), "--output", str(plan))
+
+    # Room for one dataset per `zfs list`, and the last one can't be listed
+    monkeypatch.setattr(keepoid, "destroy_arg_limit", lambda: len("pool/gone") + 1)
+    monkeypatch.setenv("FAKE_ZFS_FAIL", "pool/gone")
+    textfile = tmp_path / "keepoid.prom"
+    run_main(monkeypatch, "apply", str(plan), "--prometheus-textfile", str(textfile))
+
+    assert [call[-1] for call in listed_snapshot_calls(fake_zfs())[1:]] == ["pool/a", "pool/b", "pool/gone"]
+    assert "Error listing planned datasets: cannot open dataset" in capsys.readouterr().out
+    # Snapshots verified before the failure are destroyed, but the run failed
+    assert [line.split("\t")[0] for line in listing.read_text().splitlines()] == [
+        "pool/a@autosnap_1", "pool/b@autosnap_1", "pool/gone@autosnap_0", "pool/gone@autosnap_1",
+    ]
+    assert "keepoid_last_run_success 0" in textfile.read_text()
+
+
+def test_apply_requires_plan_file(monkeypatch, capsys):
+    run_main(monkeypatch, "apply")
+    assert "A plan file must be given to apply" in capsys.readouterr().out